@@ -23,7 +23,12 @@
 
 import os
 import re
+import time
 import errno
+import socket
+import struct
+import threading
+import collections
 
 # bitcointools -- modified deserialize.py to return raw transaction
 import BCDataStream
@@ -31,6 +36,12 @@ import deserialize
 import util
 import logging
 import base58
+import lru
+import blockindex
+import orphanpool
+import commitsched
+import sqlstats
+import connpool
 
 SCHEMA_VERSION = "Abe33"
 
@@ -41,15 +52,68 @@ CONFIG_DEFAULTS = {
     "int_type":           None,
     "upgrade":            None,
     "commit_bytes":       None,
+    "commit_blocks":      None,
+    "commit_txs":         None,
+    "commit_ms":          None,
     "log_sql":            None,
     "datadir":            None,
     "ignore_bit8_chains": None,
     "use_firstbits":      False,
     "keep_scriptsig":     True,
+    "hash_workers":       None,
+    "hash_cache":         None,
+    "id_block_size":      None,
+    "txout_cache_mb":     None,
+    "pubkey_cache_mb":    None,
+    "bulk_load":          None,
+    "pipeline_depth":     None,
+    "follow_blkfiles":    None,
+    "orphan_pool_mb":     None,
+    "connection_pool_size": None,
 }
 
 WORK_BITS = 304  # XXX more than necessary.
 
+# Number of block headers per hash worker to hash ahead of the import,
+# and number of headers per task given to a worker.
+HASH_AHEAD = 8
+HASH_BATCH = 4
+
+# Default memory budgets of the outpoint and address caches used while
+# loading, and the approximate sizes of their entries.
+TXOUT_CACHE_MB = 32
+TXOUT_CACHE_ENTRY_BYTES = 400
+PUBKEY_CACHE_MB = 16
+PUBKEY_CACHE_ENTRY_BYTES = 250
+
+# Indexes that block import does not read.  Bulk load drops them and
+# creates them again at the end.  The importer does read x_cc_block,
+# x_block_tx_tx, x_orphan_block_hashPrev and x_unlinked_txin_outpoint.
+BULK_LOAD_INDEXES = [
+    ("x_txout_pubkey",          "txout"),
+    ("x_txin_txout",            "txin"),
+    ("x_cc_chain_block_height", "chain_candidate"),
+    ("x_cc_block_height",       "chain_candidate"),
+    ]
+
+# Tables whose foreign keys bulk load drops on PostgreSQL.
+BULK_LOAD_FK_TABLES = [
+    "block", "chain_candidate", "orphan_block", "block_next", "block_tx",
+    "txout", "txin", "unlinked_txin", "block_txin",
+    ]
+
+# Minimum commit_bytes during bulk load.
+BULK_LOAD_COMMIT_BYTES = 20000000
+
+# Default megabytes of block data to hold while waiting for parents.
+ORPHAN_POOL_MB = 8
+
+# Rows per fetch when loading the block index.
+BLOCK_INDEX_FETCH = 10000
+
+# Most IDs to list in one IN (...) condition.
+ID_LIST_MAX = 500
+
 CHAIN_CONFIG = [
     #{"chain":"Bitcoin",
     # "code3":"BTC", "address_version":"\x00", "magic":"\xf9\xbe\xb4\xd9"},
@@ -111,7 +175,7 @@ class DataStore(object):
     Oracle, ODBC, and IBM DB2.
     """
 
-    def __init__(store, args):
+    def __init__(store, args, block_index_file=None):
         """
         Open and store a connection to the SQL database.
 
@@ -124,6 +188,9 @@ class DataStore(object):
 
         args.datadir names Bitcoin data directories containing
         blk0001.dat to scan for new blocks.
+
+        block_index_file names a file written by save_block_index to
+        map instead of reading the block index from the database.
         """
         if args.dbtype is None:
             raise TypeError(
@@ -140,10 +207,31 @@ class DataStore(object):
         if not args.log_sql:
             store.sqllog.setLevel(logging.ERROR)
         store.module = __import__(args.dbtype)
-        store.conn = store.connect()
-	store.conn.ping(True);
+        store._local = threading.local()
+        store._load_lock = threading.RLock()
+        store._conn_pool = None
+        pool_size = int(args.connection_pool_size or 0)
+        if pool_size > 0:
+            store._conn_pool = connpool.ConnectionPool(
+                store._new_connection, pool_size)
+        store.conn = store._new_connection()
         store.cursor = store.conn.cursor()
-        store._blocks = {}
+        store.sql_stats = sqlstats.SqlStats()
+        store._blocks = blockindex.BlockIndex()
+        store.commit_sched = commitsched.CommitScheduler()
+        store.id_block_size = int(args.id_block_size or 1)
+        store._id_ranges = {}
+        store._mysql_ids_consecutive = None
+        store._unlinked_txins = None  # Whether unlinked_txin has rows.
+
+        def new_cache(mb, default_mb, entry_bytes):
+            if mb is None:
+                mb = default_mb
+            return lru.LRUCache(int(float(mb) * 1024 * 1024 / entry_bytes))
+        store._txout_cache = new_cache(
+            args.txout_cache_mb, TXOUT_CACHE_MB, TXOUT_CACHE_ENTRY_BYTES)
+        store._pubkey_cache = new_cache(
+            args.pubkey_cache_mb, PUBKEY_CACHE_MB, PUBKEY_CACHE_ENTRY_BYTES)
 
         # Read the CONFIG and CONFIGVAR tables if present.
         store.config = store._read_config()
@@ -176,22 +264,117 @@ class DataStore(object):
         store.no_bit8_chain_ids = store._find_no_bit8_chain_ids(
             args.ignore_bit8_chains)
 
-        store.commit_bytes = args.commit_bytes
-        if store.commit_bytes is None:
-            store.commit_bytes = 0  # Commit whenever possible.
-        else:
-            store.commit_bytes = int(store.commit_bytes)
+        store.commit_bytes = store._args_commit_bytes()
+        store.commit_sched.max_bytes = store.commit_bytes
+        store.commit_sched.max_blocks, store.commit_sched.max_txs, \
+            store.commit_sched.max_ms = [
+            None if n is None else int(n) for n in
+            (args.commit_blocks, args.commit_txs, args.commit_ms)]
+        store.bulk_loading = False
 
         store.use_firstbits = (store.config['use_firstbits'] == "true")
 
-    def connect(store):
+        store.hash_workers = int(args.hash_workers or 0)
+        store.pipeline_depth = int(args.pipeline_depth or 0)
+        store.follow_blkfiles = args.follow_blkfiles in (True, "true")
+        store._followed = {}
+        store._watcher = None
+        store._hash_pool = None
+        store.hash_cache = args.hash_cache in (True, "true")
+        store._hash_caches = {}
+        store.orphan_pool_bytes = int(float(
+                ORPHAN_POOL_MB if args.orphan_pool_mb is None
+                else args.orphan_pool_mb) * 1024 * 1024)
+
+        if block_index_file is None:
+            store._load_block_index()
+        else:
+            store.map_block_index(block_index_file)
+        store.commit()
+
+    def _args_commit_bytes(store):
+        args = store.args
+        if args.commit_bytes is None:
+            if (args.commit_blocks is None and args.commit_txs is None and
+                args.commit_ms is None):
+                return 0  # Commit whenever possible.
+            return None  # Commit by the other limits.
+        return int(args.commit_bytes)
+
+    # A thread holding a pooled connection sees it as store.conn and its
+    # cursor as store.cursor.  Other threads share the store's own.
+    def _get_conn(store):
+        return getattr(store._local, "conn", store._conn)
+
+    def _set_conn(store, conn):
+        if hasattr(store._local, "conn"):
+            store._local.conn = conn
+        else:
+            store._conn = conn
+
+    conn = property(_get_conn, _set_conn)
+
+    def _get_cursor(store):
+        return getattr(store._local, "cursor", store._cursor)
+
+    def _set_cursor(store, cursor):
+        if hasattr(store._local, "cursor"):
+            store._local.cursor = cursor
+        else:
+            store._cursor = cursor
+
+    cursor = property(_get_cursor, _set_cursor)
+
+    def _new_connection(store):
+        kwargs = {}
+        if store._conn_pool is not None and \
+                hasattr(store.module, "sqlite_version"):
+            # Connections move between threads.
+            kwargs["check_same_thread"] = False
+        conn = store.connect(**kwargs)
+        if hasattr(conn, "ping"):
+            conn.ping(True)  # MySQLdb: reconnect if disconnected.
+        return conn
+
+    def checkout_connection(store):
+        """
+        Give the calling thread a connection and cursor of its own
+        from the pool until checkin_connection.  Without
+        connection_pool_size, threads share the store's connection.
+        """
+        if store._conn_pool is None:
+            return
+        conn = store._conn_pool.get()
+        try:
+            store._local.cursor = conn.cursor()
+        except:
+            store._conn_pool.discard(conn)
+            raise
+        store._local.conn = conn
+
+    def checkin_connection(store):
+        """Roll back and return the thread's pooled connection."""
+        if not hasattr(store._local, "conn"):
+            return
+        conn, cursor = store._local.conn, store._local.cursor
+        del store._local.conn, store._local.cursor
+        try:
+            cursor.close()
+            conn.rollback()
+        except Exception, e:
+            store.log.warning("Closing pooled connection: %s", e)
+            store._conn_pool.discard(conn)
+            return
+        store._conn_pool.put(conn)
+
+    def connect(store, **kwargs):
         cargs = store.args.connect_args
 
         if cargs is None:
-            conn = store.module.connect()
+            conn = store.module.connect(**kwargs)
         else:
             try:
-                conn = store._connect(cargs)
+                conn = store._connect(cargs, **kwargs)
             except UnicodeError:
                 # Perhaps this driver needs its strings encoded.
                 # Python's default is ASCII.  Let's try UTF-8, which
@@ -208,15 +391,15 @@ class DataStore(object):
                     if isinstance(obj, unicode):
                         return obj.encode(enc)
                     return obj
-                conn = store._connect(to_utf8(cargs))
+                conn = store._connect(to_utf8(cargs), **kwargs)
                 store.log.info("Connection required conversion to UTF-8")
 
         return conn
 
-    def _connect(store, cargs):
+    def _connect(store, cargs, **kwargs):
         if isinstance(cargs, dict):
+            cargs = dict(cargs, **kwargs)
             if ""  in cargs:
-                cargs = cargs.copy()
                 nkwargs = cargs[""]
                 del(cargs[""])
                 if isinstance(nkwargs, list):
@@ -225,8 +408,13 @@ class DataStore(object):
             else:
                 return store.module.connect(**cargs)
         if isinstance(cargs, list):
-            return store.module.connect(*cargs)
-        return store.module.connect(cargs)
+            return store.module.connect(*cargs, **kwargs)
+        return store.module.connect(cargs, **kwargs)
+
+    def disconnect(store):
+        """Close the connection until reconnect()."""
+        store.cursor.close()
+        store.conn.close()
 
     def reconnect(store):
         store.log.info("Reconnecting to database.")
@@ -382,13 +570,16 @@ class DataStore(object):
             raise Exception("Unsupported int-type %s" % (val,))
 
         val = store.config.get('sequence_type')
+        reserve_ids = None
         if val in (None, 'update'):
             new_id = lambda key: store._new_id_update(key)
+            reserve_ids = lambda key, n: store._reserve_ids_update(key, n)
             create_sequence = lambda key: store._create_sequence_update(key)
             drop_sequence = lambda key: store._drop_sequence_update(key)
 
         elif val == 'mysql':
             new_id = lambda key: store._new_id_mysql(key)
+            reserve_ids = lambda key, n: store._reserve_ids_mysql(key, n)
             create_sequence = lambda key: store._create_sequence_mysql(key)
             drop_sequence = lambda key: store._drop_sequence_mysql(key)
 
@@ -398,16 +589,24 @@ class DataStore(object):
 
             if val == 'oracle':
                 new_id = lambda key: store._new_id_oracle(key)
+                reserve_ids = lambda key, n: store._reserve_ids_oracle(key, n)
             elif val == 'nvf':
                 new_id = lambda key: store._new_id_nvf(key)
             elif val == 'postgres':
                 new_id = lambda key: store._new_id_postgres(key)
+                reserve_ids = lambda key, n: store._reserve_ids_postgres(key,
+                                                                         n)
             elif val == 'db2':
                 new_id = lambda key: store._new_id_db2(key)
                 create_sequence = lambda key: store._create_sequence_db2(key)
             else:
                 raise Exception("Unsupported sequence-type %s" % (val,))
 
+        if reserve_ids is not None and store.id_block_size > 1:
+            new_id = lambda key: store._new_id_reserved(key, reserve_ids)
+            create_sequence = store._forget_ids_after(create_sequence)
+            drop_sequence = store._forget_ids_after(drop_sequence)
+
         # Convert Oracle LOB to str.
         if hasattr(store.module, "LOB") and isinstance(store.module.LOB, type):
             def fix_lob(fn):
@@ -453,11 +652,15 @@ class DataStore(object):
         store.create_sequence = create_sequence
         store.drop_sequence = drop_sequence
 
-    def sql(store, stmt, params=()):
+    def _transform_cached(store, stmt):
         cached = store._sql_cache.get(stmt)
         if cached is None:
             cached = store.sql_transform(stmt)
             store._sql_cache[stmt] = cached
+        return cached
+
+    def _execute(store, stmt, params):
+        cached = store._transform_cached(stmt)
         store.sqllog.info("EXEC: %s %s", cached, params)
         try:
             store.cursor.execute(cached, params)
@@ -465,6 +668,37 @@ class DataStore(object):
             store.sqllog.info("EXCEPTION: %s", e)
             raise
 
+    def sql(store, stmt, params=()):
+        start = time.time()
+        store._execute(stmt, params)
+        store.sql_stats.record(stmt, time.time() - start)
+
+    def sql_many(store, stmt, params_seq):
+        """
+        Execute stmt once per tuple in params_seq, in as few round
+        trips as the driver allows.
+        """
+        if not params_seq:
+            return
+        cached = store._transform_cached(stmt)
+        store.sqllog.info("EXECMANY: %s %s", cached, params_seq)
+        start = time.time()
+        try:
+            execute_batch = None
+            if store.module.__name__ == "psycopg2":
+                # psycopg2's executemany sends one statement per row.
+                import psycopg2.extras
+                execute_batch = getattr(psycopg2.extras, "execute_batch",
+                                        None)
+            if execute_batch is None:
+                store.cursor.executemany(cached, params_seq)
+            else:
+                execute_batch(store.cursor, cached, params_seq)
+        except Exception, e:
+            store.sqllog.info("EXCEPTION: %s", e)
+            raise
+        store.sql_stats.record(stmt, time.time() - start)
+
     def ddl(store, stmt):
         if stmt.lstrip().startswith("CREATE TABLE "):
             stmt += store.config['create_table_epilogue']
@@ -584,14 +818,18 @@ class DataStore(object):
         return ret
 
     def selectrow(store, stmt, params=()):
-        store.sql(stmt, params)
+        start = time.time()
+        store._execute(stmt, params)
         ret = store.cursor.fetchone()
+        store.sql_stats.record(stmt, time.time() - start, ret is not None)
         store.sqllog.debug("FETCH: %s", ret)
         return ret
 
     def _selectall(store, stmt, params=()):
-        store.sql(stmt, params)
+        start = time.time()
+        store._execute(stmt, params)
         ret = store.cursor.fetchall()
+        store.sql_stats.record(stmt, time.time() - start, len(ret))
         store.sqllog.debug("FETCHALL: %s", ret)
         return ret
 
@@ -697,6 +935,9 @@ class DataStore(object):
         """
         Allocate a synthetic identifier by updating a table.
         """
+        return store._advance_sequence_update(key, 1)
+
+    def _advance_sequence_update(store, key, count):
         while True:
             row = store.selectrow(
                 "SELECT nextid FROM abe_sequences WHERE sequence_key = ?",
@@ -705,13 +946,36 @@ class DataStore(object):
                 raise Exception("Sequence %s does not exist" % (key,))
 
             ret = row[0]
-            store.sql("UPDATE abe_sequences SET nextid = nextid + 1"
+            store.sql("UPDATE abe_sequences SET nextid = nextid + ?"
                       " WHERE sequence_key = ? AND nextid = ?",
-                      (key, ret))
+                      (count, key, ret))
             if store.cursor.rowcount == 1:
                 return ret
             store.log.info('Contention on abe_sequences %s:%d', key, ret)
 
+    def _reserve_ids_update(store, key, count):
+        first = int(store._advance_sequence_update(key, count))
+        return xrange(first, first + count)
+
+    def _new_id_reserved(store, key, reserve_ids):
+        """
+        Allocate an identifier from a block of id_block_size
+        identifiers reserved in one statement by reserve_ids.
+        Identifiers left unused when the process exits are never
+        allocated.
+        """
+        ids = store._id_ranges.get(key)
+        if not ids:
+            ids = collections.deque(reserve_ids(key, store.id_block_size))
+            store._id_ranges[key] = ids
+        return ids.popleft()
+
+    def _forget_ids_after(store, fn):
+        def ret(key):
+            store._id_ranges.pop(key, None)
+            return fn(key)
+        return ret
+
     def _get_sequence_initial_value(store, key):
         (ret,) = store.selectrow("SELECT MAX(" + key + "_id) FROM " + key)
         ret = 1 if ret is None else ret + 1
@@ -749,6 +1013,11 @@ class DataStore(object):
     def _drop_sequence(store, key):
         store.ddl("DROP SEQUENCE %s_seq" % (key,))
 
+    def _reserve_ids_oracle(store, key, count):
+        return sorted(int(row[0]) for row in store.selectall(
+                "SELECT " + key + "_seq.NEXTVAL FROM DUAL"
+                " CONNECT BY LEVEL <= ?", (count,)))
+
     def _new_id_nvf(store, key):
         (ret,) = store.selectrow("SELECT NEXT VALUE FOR " + key + "_seq")
         return ret
@@ -757,6 +1026,11 @@ class DataStore(object):
         (ret,) = store.selectrow("SELECT NEXTVAL('" + key + "_seq')")
         return ret
 
+    def _reserve_ids_postgres(store, key, count):
+        return sorted(int(row[0]) for row in store.selectall(
+                "SELECT NEXTVAL('" + key + "_seq')"
+                " FROM generate_series(1, ?)", (count,)))
+
     def _create_sequence_db2(store, key):
         store.commit()
         try:
@@ -791,17 +1065,83 @@ class DataStore(object):
             store.sql("DELETE FROM " + key + "_seq WHERE id < ?", (ret,))
         return ret
 
+    def _reserve_ids_mysql(store, key, count):
+        # LAST_INSERT_ID() is the first of a multi-row insert's IDs,
+        # but they are consecutive only under the "traditional" and
+        # "consecutive" InnoDB auto-increment lock modes.
+        if store._mysql_ids_consecutive is None:
+            try:
+                (mode,) = store.selectrow(
+                    "SELECT @@innodb_autoinc_lock_mode")
+                store._mysql_ids_consecutive = int(mode) < 2
+            except store.module.DatabaseError:
+                store._mysql_ids_consecutive = False
+            if not store._mysql_ids_consecutive:
+                store.log.info("Not reserving IDs: MySQL may not"
+                               " allocate them consecutively")
+        if not store._mysql_ids_consecutive:
+            return [store._new_id_mysql(key)]
+
+        store.sql("INSERT INTO " + key + "_seq () VALUES ()" +
+                  ", ()" * (count - 1))
+        (ret,) = store.selectrow("SELECT LAST_INSERT_ID()")
+        ret = int(ret)
+        if ret / 1000 != (ret + count) / 1000:
+            store.sql("DELETE FROM " + key + "_seq WHERE id < ?",
+                      (ret + count - 1,))
+        return xrange(ret, ret + count)
+
     def commit(store):
         store.sqllog.info("COMMIT")
+        start = time.time()
         store.conn.commit()
+        sched = store.commit_sched
+        if sched.blocks > 0:
+            store.log.debug(
+                "commit: %d blocks, %d txs, %d rows, %d bytes"
+                " over %.0f ms, committed in %.1f ms",
+                sched.blocks, sched.txs, sched.rows, sched.nbytes,
+                sched.elapsed_ms(), (time.time() - start) * 1000)
+        sched.reset()
+        store._blocks.commit()
+        for name, cache in (("txout", store._txout_cache),
+                            ("pubkey", store._pubkey_cache)):
+            cache.commit()
+            if cache.max_size > 0:
+                store.log.debug("%s cache: %d hits, %d misses, %d entries",
+                                name, cache.hits, cache.misses, len(cache))
 
     def rollback(store):
         store.sqllog.info("ROLLBACK")
         store.conn.rollback()
+        if hasattr(store._local, "conn"):
+            # Only catch_up changes what the store holds in memory,
+            # and it uses the store's own connection.
+            return
+        store._txout_cache.rollback()
+        store._pubkey_cache.rollback()
+        store._blocks.rollback()
+        # A rolled-back abe_sequences update no longer reserves them.
+        store._id_ranges = {}
+        store._unlinked_txins = None
 
     def close(store):
         store.sqllog.info("CLOSE")
         store.conn.close()
+        if store._conn_pool is not None:
+            store._conn_pool.close()
+        if store._hash_pool is not None:
+            store._hash_pool.terminate()
+            store._hash_pool = None
+        for cache in store._hash_caches.values():
+            if cache is not None:
+                cache.close()
+        store._hash_caches = {}
+        for datadir_id in store._followed.keys():
+            store._unfollow_blkfile(datadir_id)
+        if store._watcher is not None:
+            store._watcher.close()
+            store._watcher = None
 
     def get_ddl(store, key):
         return store._ddl[key]
@@ -915,6 +1255,16 @@ LEFT JOIN block prev ON (b.prev_block_id = prev.block_id)""",
     configvar_value VARCHAR(255)
 )""",
 
+            "x_cc_chain_block_height":
+"""CREATE INDEX x_cc_chain_block_height
+    ON chain_candidate (chain_id, block_height)""",
+            "x_cc_block_height":
+"""CREATE INDEX x_cc_block_height ON chain_candidate (block_height)""",
+            "x_txout_pubkey":
+"""CREATE INDEX x_txout_pubkey ON txout (pubkey_id)""",
+            "x_txin_txout":
+"""CREATE INDEX x_txin_txout ON txin (txout_id)""",
+
             "abe_sequences":
 """CREATE TABLE abe_sequences (
     sequence_key VARCHAR(100) NOT NULL PRIMARY KEY,
@@ -1012,9 +1362,8 @@ store._ddl['configvar'],
     FOREIGN KEY (block_id) REFERENCES block (block_id)
 )""",
 """CREATE INDEX x_cc_block ON chain_candidate (block_id)""",
-"""CREATE INDEX x_cc_chain_block_height
-    ON chain_candidate (chain_id, block_height)""",
-"""CREATE INDEX x_cc_block_height ON chain_candidate (block_height)""",
+store._ddl['x_cc_chain_block_height'],
+store._ddl['x_cc_block_height'],
 
 # An orphan block must remember its hashPrev.
 """CREATE TABLE orphan_block (
@@ -1076,7 +1425,7 @@ store._ddl['configvar'],
     FOREIGN KEY (pubkey_id)
         REFERENCES pubkey (pubkey_id)
 )""",
-"""CREATE INDEX x_txout_pubkey ON txout (pubkey_id)""",
+store._ddl['x_txout_pubkey'],
 
 # A transaction in-point.
 """CREATE TABLE txin (
@@ -1090,7 +1439,7 @@ store._ddl['configvar'],
     FOREIGN KEY (tx_id)
         REFERENCES tx (tx_id)
 )""",
-"""CREATE INDEX x_txin_txout ON txin (txout_id)""",
+store._ddl['x_txin_txout'],
 
 # While TXIN.TXOUT_ID can not be found, we must remember TXOUT_POS,
 # a.k.a. PREVOUT_N.
@@ -1226,6 +1575,29 @@ store._ddl['txout_approx'],
             conn.rollback()
             conn.close()
 
+    def get_lock_pid(store):
+        """Return the process ID last recorded in abe_lock, or None."""
+        if store.version_below('Abe26'):
+            return None
+        row = store.selectrow("SELECT pid FROM abe_lock WHERE lock_id = 1")
+        return None if row is None or row[0] is None else int(row[0])
+
+    def set_lock_pid(store, pid):
+        """Record in abe_lock a process, such as a web server, that
+        bulk load must not run alongside."""
+        if store.version_below('Abe26'):
+            return
+        store.sql("UPDATE abe_lock SET pid = ? WHERE lock_id = 1", (str(pid),))
+        store.commit()
+
+    def clear_lock_pid(store, pid):
+        """Forget pid if abe_lock still records it."""
+        if store.version_below('Abe26'):
+            return
+        store.sql("UPDATE abe_lock SET pid = NULL"
+                  " WHERE lock_id = 1 AND pid = ?", (str(pid),))
+        store.commit()
+
     def version_below(store, vers):
         sv = store.config['schema_version'].replace('Abe', '')
         vers = vers.replace('Abe', '')
@@ -1566,50 +1938,103 @@ store._ddl['txout_approx'],
         assert isinstance(height, int), height
         assert prev_id is None or isinstance(prev_id, int)
         assert search_id is None or isinstance(search_id, int)
-        block = {
-            'height':    height,
-            'prev_id':   prev_id,
-            'search_id': search_id}
-        store._blocks[block_id] = block
-        return block
+        store._blocks.put(block_id, height, prev_id, search_id)
+
+    def _load_block_index(store):
+        def rows(stmt):
+            store.sql(stmt)
+            while True:
+                batch = store.cursor.fetchmany(BLOCK_INDEX_FETCH)
+                if not batch:
+                    break
+                for row in batch:
+                    yield row
+        store._blocks.load(rows("""
+            SELECT block_id, block_height, prev_block_id, search_block_id
+              FROM block
+             WHERE block_height IS NOT NULL"""))
+        store._blocks.load_main(rows("""
+            SELECT chain_id, block_height, block_id
+              FROM chain_candidate
+             WHERE in_longest = 1
+               AND block_height IS NOT NULL"""))
+        store.log.info("Block index: %d blocks in %d bytes",
+                       store._blocks.count, store._blocks.nbytes())
+
+    def save_block_index(store, path):
+        """
+        Write the block index with every chain's longest chain to
+        path for map_block_index in other processes.
+        """
+        with store._load_lock:
+            if not store._blocks.loaded:
+                store._load_block_index()
+            for (chain_id,) in store.selectall("SELECT chain_id FROM chain"):
+                store.main_chain_height(chain_id)
+            store.commit()
+            store._blocks.save(path)
+
+    def map_block_index(store, path):
+        """Use the block index in a file written by save_block_index."""
+        store._blocks = blockindex.MappedBlockIndex(path)
+
+    def refresh_block_index(store):
+        """Map the block index file again if it has been replaced."""
+        if store._blocks.changed():
+            store._blocks.reopen()
 
     def _load_block(store, block_id):
-        block = store._blocks.get(block_id)
-        if block is None:
-            row = store.selectrow("""
-                SELECT block_height, prev_block_id, search_block_id
-                  FROM block
-                 WHERE block_id = ?""", (block_id,))
-            if row is None:
-                return None
-            height, prev_id, search_id = row
-            block = store.cache_block(
-                block_id, int(height),
-                None if prev_id is None else int(prev_id),
-                None if search_id is None else int(search_id))
-        return block
+        """
+        Return the height of the given block, adding it to the block
+        index if necessary, or None if it has no height.
+        """
+        blocks = store._blocks
+        if block_id in blocks:
+            return blocks.height(block_id)
+        if not blocks.loaded:
+            store._load_block_index()
+            if block_id in blocks:
+                return blocks.height(block_id)
+        row = store.selectrow("""
+            SELECT block_height, prev_block_id, search_block_id
+              FROM block
+             WHERE block_id = ?""", (block_id,))
+        if row is None or row[0] is None:
+            return None
+        height, prev_id, search_id = row
+        store.cache_block(
+            block_id, int(height),
+            None if prev_id is None else int(prev_id),
+            None if search_id is None else int(search_id))
+        return int(height)
 
     def get_block_id_at_height(store, height, descendant_id):
         if height is None:
             return None
+        blocks = store._blocks
         while True:
-            block = store._load_block(descendant_id)
-            if block['height'] == height:
+            block_height = store._load_block(descendant_id)
+            if block_height is None:
+                return None
+            if block_height == height:
                 return descendant_id
-            descendant_id = block[
-                'search_id'
-                if util.get_search_height(block['height']) >= height else
-                'prev_id']
+            # Longest-chain blocks need no walk.
+            ancestor_id = blocks.main_ancestor(
+                descendant_id, block_height, height)
+            if ancestor_id is not None:
+                return ancestor_id
+            if util.get_search_height(block_height) >= height:
+                descendant_id = blocks.search_id(descendant_id)
+            else:
+                descendant_id = blocks.prev_id(descendant_id)
 
     def is_descended_from(store, block_id, ancestor_id):
 #        ret = store._is_descended_from(block_id, ancestor_id)
 #        store.log.debug("%d is%s descended from %d", block_id, '' if ret else ' NOT', ancestor_id)
 #        return ret
 #    def _is_descended_from(store, block_id, ancestor_id):
-        block = store._load_block(block_id)
-        ancestor = store._load_block(ancestor_id)
-        height = ancestor['height']
-        return block['height'] >= height and \
+        height = store._load_block(ancestor_id)
+        return store._load_block(block_id) >= height and \
             store.get_block_id_at_height(height, block_id) == ancestor_id
 
     def find_prev(store, hash):
@@ -1642,6 +2067,8 @@ store._ddl['txout_approx'],
         # In the common case, all the block's txins _are_ linked, and we
         # can avoid a query if we notice this.
         all_txins_linked = True
+        new_tx_ids = []
+        new_rows = 1 + len(b['transactions'])  # block and block_tx
 
         for pos in xrange(len(b['transactions'])):
             tx = b['transactions'][pos]
@@ -1657,6 +2084,8 @@ store._ddl['txout_approx'],
                     tx['tx_id'] = store.import_and_commit_tx(tx, pos == 0)
                 else:
                     tx['tx_id'] = store.import_tx(tx, pos == 0)
+                    new_tx_ids.append(tx['tx_id'])
+                new_rows += 1 + len(tx['txIn']) + len(tx['txOut'])
                 if tx['unlinked_count'] > 0:
                     all_txins_linked = False
 
@@ -1670,6 +2099,9 @@ store._ddl['txout_approx'],
                 b['value_out'] += tx['value_out']
             b['value_destroyed'] += tx['value_destroyed']
 
+        # Transactions committed one at a time were linked already.
+        store._link_unlinked_txins(new_tx_ids)
+
         # Get a new block ID.
         block_id = int(store.new_id("block"))
         b['block_id'] = block_id
@@ -1765,22 +2197,23 @@ store._ddl['txout_approx'],
             raise
 
         # List the block's transactions in block_tx.
-        for tx_pos in xrange(len(b['transactions'])):
-            tx = b['transactions'][tx_pos]
-            store.sql("""
-                INSERT INTO block_tx
-                    (block_id, tx_id, tx_pos)
-                VALUES (?, ?, ?)""",
-                      (block_id, tx['tx_id'], tx_pos))
+        store.sql_many("""
+            INSERT INTO block_tx
+                (block_id, tx_id, tx_pos)
+            VALUES (?, ?, ?)""",
+                       [(block_id, b['transactions'][tx_pos]['tx_id'], tx_pos)
+                        for tx_pos in xrange(len(b['transactions']))])
+        for tx in b['transactions']:
             store.log.info("block_tx %d %d", block_id, tx['tx_id'])
+        store.commit_sched.add(blocks=1, txs=len(b['transactions']),
+                               rows=new_rows)
 
         if b['height'] is not None:
             store._populate_block_txin(block_id)
 
             if all_txins_linked or not store._has_unlinked_txins(block_id):
                 b['ss_destroyed'] = store._get_block_ss_destroyed(
-                    block_id, b['nTime'],
-                    map(lambda tx: tx['tx_id'], b['transactions']))
+                    block_id, b['nTime'])
                 if ss_created is None or prev_ss is None:
                     b['ss'] = None
                 else:
@@ -1831,20 +2264,48 @@ store._ddl['txout_approx'],
         # Create rows in block_txin.  In case of duplicate transactions,
         # choose the one with the lowest block ID.  XXX For consistency,
         # it should be the lowest height instead of block ID.
-        for row in store.selectall("""
+        rows = [(txin_id, int(oblock_id)) for txin_id, oblock_id in
+                store.selectall("""
             SELECT txin.txin_id, MIN(obt.block_id)
               FROM block_tx bt
               JOIN txin ON (txin.tx_id = bt.tx_id)
               JOIN txout ON (txin.txout_id = txout.txout_id)
               JOIN block_tx obt ON (txout.tx_id = obt.tx_id)
              WHERE bt.block_id = ?
-             GROUP BY txin.txin_id""", (block_id,)):
-            (txin_id, oblock_id) = row
-            if store.is_descended_from(block_id, int(oblock_id)):
-                store.sql("""
-                    INSERT INTO block_txin (block_id, txin_id, out_block_id)
-                    VALUES (?, ?, ?)""",
-                          (block_id, txin_id, oblock_id))
+             GROUP BY txin.txin_id""", (block_id,))]
+        if not rows:
+            return
+        ancestors = store._ancestors_among(
+            block_id, set(oblock_id for txin_id, oblock_id in rows))
+        store.sql_many("""
+            INSERT INTO block_txin (block_id, txin_id, out_block_id)
+            VALUES (?, ?, ?)""",
+                       [(block_id, txin_id, oblock_id)
+                        for txin_id, oblock_id in rows
+                        if oblock_id in ancestors])
+
+    def _ancestors_among(store, block_id, block_ids):
+        """
+        Return the subset of block_ids naming block_id or one of its
+        ancestors.  Equivalent to calling is_descended_from on each,
+        but walks down from block_id only once.
+        """
+        ret = set()
+        candidates = sorted(
+            [(store._load_block(id), id) for id in block_ids],
+            reverse=True)
+        descendant_id = block_id
+        height = store._load_block(block_id)
+        for candidate_height, candidate_id in candidates:
+            if candidate_height > height:
+                continue
+            # Each ancestor found is a descendant of the lower ones.
+            height = candidate_height
+            descendant_id = store.get_block_id_at_height(
+                height, descendant_id)
+            if descendant_id == candidate_id:
+                ret.add(candidate_id)
+        return ret
 
     def _has_unlinked_txins(store, block_id):
         (unlinked_count,) = store.selectrow("""
@@ -1855,21 +2316,19 @@ store._ddl['txout_approx'],
              WHERE bt.block_id = ?""", (block_id,))
         return unlinked_count > 0
 
-    def _get_block_ss_destroyed(store, block_id, nTime, tx_ids):
-        block_ss_destroyed = 0
-        for tx_id in tx_ids:
-            destroyed = int(store.selectrow("""
-                SELECT COALESCE(SUM(txout_approx.txout_approx_value *
-                                    (? - b.block_nTime)), 0)
-                  FROM block_txin bti
-                  JOIN txin ON (bti.txin_id = txin.txin_id)
-                  JOIN txout_approx ON (txin.txout_id = txout_approx.txout_id)
-                  JOIN block_tx obt ON (txout_approx.tx_id = obt.tx_id)
-                  JOIN block b ON (obt.block_id = b.block_id)
-                 WHERE bti.block_id = ? AND txin.tx_id = ?""",
-                                            (nTime, block_id, tx_id))[0])
-            block_ss_destroyed += destroyed
-        return block_ss_destroyed
+    def _get_block_ss_destroyed(store, block_id, nTime):
+        # block_txin holds exactly the linked inputs of the block's
+        # transactions, so one grouped query covers them all.
+        (destroyed,) = store.selectrow("""
+            SELECT COALESCE(SUM(txout_approx.txout_approx_value *
+                                (? - b.block_nTime)), 0)
+              FROM block_txin bti
+              JOIN txin ON (bti.txin_id = txin.txin_id)
+              JOIN txout_approx ON (txin.txout_id = txout_approx.txout_id)
+              JOIN block_tx obt ON (txout_approx.tx_id = obt.tx_id)
+              JOIN block b ON (obt.block_id = b.block_id)
+             WHERE bti.block_id = ?""", (nTime, block_id))
+        return int(destroyed)
 
     # Propagate cumulative values to descendant blocks.  Return info
     # about the longest chains containing b.  The returned dictionary
@@ -1946,7 +2405,8 @@ store._ddl['txout_approx'],
                 else:
                     total_ss = b['total_ss'] + new_seconds * b['satoshis']
 
-            if satoshis < 0 and b['satoshis'] is not None and \
+            if satoshis is not None and satoshis < 0 and \
+                    b['satoshis'] is not None and \
                     b['satoshis'] >= 0 and generated is not None:
                 satoshis += 1 + b['satoshis'] + generated
 
@@ -1982,17 +2442,11 @@ store._ddl['txout_approx'],
 
                 store._populate_block_txin(int(next_id))
 
-                if b['ss'] is None or store._has_unlinked_txins(next_id):
+                if b['ss'] is None or b['satoshis'] is None or \
+                        store._has_unlinked_txins(next_id):
                     pass
                 else:
-                    tx_ids = map(
-                        lambda row: row[0],
-                        store.selectall("""
-                            SELECT tx_id
-                              FROM block_tx
-                             WHERE block_id = ?""", (next_id,)))
-                    destroyed = store._get_block_ss_destroyed(
-                        next_id, nTime, tx_ids)
+                    destroyed = store._get_block_ss_destroyed(next_id, nTime)
                     ss = b['ss'] + b['satoshis'] * (nTime - b['nTime']) \
                         - destroyed
 
@@ -2071,6 +2525,7 @@ store._ddl['txout_approx'],
         # Import transaction outputs.
         tx['value_out'] = 0
         tx['value_destroyed'] = 0
+        txout_rows = []
         for pos in xrange(len(tx['txOut'])):
             txout = tx['txOut'][pos]
             tx['value_out'] += txout['value']
@@ -2080,27 +2535,28 @@ store._ddl['txout_approx'],
             if pubkey_id is not None and pubkey_id <= 0:
                 tx['value_destroyed'] += txout['value']
 
-            store.sql("""
-                INSERT INTO txout (
-                    txout_id, tx_id, txout_pos, txout_value,
-                    txout_scriptPubKey, pubkey_id
-                ) VALUES (?, ?, ?, ?, ?, ?)""",
-                      (txout_id, tx_id, pos, store.intin(txout['value']),
-                       store.binin(txout['scriptPubKey']), pubkey_id))
-            for row in store.selectall("""
-                SELECT txin_id
-                  FROM unlinked_txin
-                 WHERE txout_tx_hash = ?
-                   AND txout_pos = ?""", (dbhash, pos)):
-                (txin_id,) = row
-                store.sql("UPDATE txin SET txout_id = ? WHERE txin_id = ?",
-                          (txout_id, txin_id))
-                store.sql("DELETE FROM unlinked_txin WHERE txin_id = ?",
-                          (txin_id,))
+            txout_rows.append(
+                (txout_id, tx_id, pos, store.intin(txout['value']),
+                 store.binin(txout['scriptPubKey']), pubkey_id))
+
+        store.sql_many("""
+            INSERT INTO txout (
+                txout_id, tx_id, txout_pos, txout_value,
+                txout_scriptPubKey, pubkey_id
+            ) VALUES (?, ?, ?, ?, ?, ?)""", txout_rows)
+        for pos in xrange(len(tx['txOut'])):
+            store._txout_cache.put((tx['hash'], pos),
+                                   (txout_rows[pos][0],
+                                    tx['txOut'][pos]['value']))
+
+        # import_block or import_and_commit_tx links inputs seen
+        # before this transaction.
 
         # Import transaction inputs.
         tx['value_in'] = 0
         tx['unlinked_count'] = 0
+        txin_rows = []
+        unlinked_rows = []
         for pos in xrange(len(tx['txIn'])):
             txin = tx['txIn'][pos]
             txin_id = store.new_id("txin")
@@ -2115,34 +2571,76 @@ store._ddl['txout_approx'],
                 elif tx['value_in'] is not None:
                     tx['value_in'] += value
 
-            store.sql("""
-                INSERT INTO txin (
-                    txin_id, tx_id, txin_pos, txout_id""" + (""",
-                    txin_scriptSig, txin_sequence""" if store.keep_scriptsig
-                                                             else "") + """
-                ) VALUES (?, ?, ?, ?""" + (", ?, ?" if store.keep_scriptsig
-                                           else "") + """)""",
-                      (txin_id, tx_id, pos, txout_id,
-                       store.binin(txin['scriptSig']),
-                       store.intin(txin['sequence'])) if store.keep_scriptsig
-                      else (txin_id, tx_id, pos, txout_id))
+            txin_rows.append(
+                (txin_id, tx_id, pos, txout_id,
+                 store.binin(txin['scriptSig']),
+                 store.intin(txin['sequence'])) if store.keep_scriptsig
+                else (txin_id, tx_id, pos, txout_id))
             if not is_coinbase and txout_id is None:
                 tx['unlinked_count'] += 1
-                store.sql("""
-                    INSERT INTO unlinked_txin (
-                        txin_id, txout_tx_hash, txout_pos
-                    ) VALUES (?, ?, ?)""",
-                          (txin_id, store.hashin(txin['prevout_hash']),
-                           store.intin(txin['prevout_n'])))
+                unlinked_rows.append(
+                    (txin_id, store.hashin(txin['prevout_hash']),
+                     store.intin(txin['prevout_n'])))
+
+        store.sql_many("""
+            INSERT INTO txin (
+                txin_id, tx_id, txin_pos, txout_id""" + (""",
+                txin_scriptSig, txin_sequence""" if store.keep_scriptsig
+                                                         else "") + """
+            ) VALUES (?, ?, ?, ?""" + (", ?, ?" if store.keep_scriptsig
+                                       else "") + """)""", txin_rows)
+        store.sql_many("""
+            INSERT INTO unlinked_txin (
+                txin_id, txout_tx_hash, txout_pos
+            ) VALUES (?, ?, ?)""", unlinked_rows)
+        if unlinked_rows:
+            store._unlinked_txins = True
 
         # XXX Could populate PUBKEY.PUBKEY with txin scripts...
         # or leave that to an offline process.  Nothing in this program
         # requires them.
         return tx_id
 
+    def _link_unlinked_txins(store, tx_ids):
+        """
+        Link inputs loaded before the outputs they spend, now that the
+        given transactions' outputs are loaded.
+        """
+        if store._unlinked_txins is None:
+            # Usually there are none, and then we need not look.
+            rows = store.selectall("""
+                SELECT txin_id
+                  FROM unlinked_txin
+                 LIMIT 1""")
+            store._unlinked_txins = bool(rows) and rows[0] is not None
+        if not store._unlinked_txins:
+            return
+
+        links = []
+        for i in xrange(0, len(tx_ids), ID_LIST_MAX):
+            chunk = tx_ids[i : i + ID_LIST_MAX]
+            links += store.selectall("""
+                SELECT txout.txout_id, u.txin_id
+                  FROM unlinked_txin u
+                  JOIN tx ON (tx.tx_hash = u.txout_tx_hash)
+                  JOIN txout ON (txout.tx_id = tx.tx_id
+                             AND txout.txout_pos = u.txout_pos)
+                 WHERE tx.tx_id IN (""" + ", ".join(["?"] * len(chunk)) +
+                                     ")", chunk)
+        if links:
+            store.sql_many("UPDATE txin SET txout_id = ? WHERE txin_id = ?",
+                           links)
+            store.sql_many("DELETE FROM unlinked_txin WHERE txin_id = ?",
+                           [(txin_id,) for txout_id, txin_id in links])
+            # Perhaps none remain.
+            store._unlinked_txins = None
+
     def import_and_commit_tx(store, tx, is_coinbase):
         try:
             tx_id = store.import_tx(tx, is_coinbase)
+            # Link in the same commit, lest a restart find the
+            # transaction loaded and never link its spenders.
+            store._link_unlinked_txins([tx_id])
             store.commit()
 
         except store.module.DatabaseError:
@@ -2267,29 +2765,8 @@ store._ddl['txout_approx'],
             if row:
                 # New longest chain.
                 in_longest = 1
-                to_connect = []
-                to_disconnect = []
-                winner_id = top['block_id']
-                winner_height = top['height']
-                while loser_height > winner_height:
-                    to_disconnect.insert(0, loser_id)
-                    loser_id = store.get_prev_block_id(loser_id)
-                    loser_height -= 1
-                while winner_height > loser_height:
-                    to_connect.insert(0, winner_id)
-                    winner_id = store.get_prev_block_id(winner_id)
-                    winner_height -= 1
-                loser_height = None
-                while loser_id <> winner_id:
-                    to_disconnect.insert(0, loser_id)
-                    loser_id = store.get_prev_block_id(loser_id)
-                    to_connect.insert(0, winner_id)
-                    winner_id = store.get_prev_block_id(winner_id)
-                    winner_height -= 1
-                for block_id in to_disconnect:
-                    store.disconnect_block(block_id, chain_id)
-                for block_id in to_connect:
-                    store.connect_block(block_id, chain_id)
+                store.reorganize(chain_id, int(loser_id), int(loser_height),
+                                 top['block_id'], top['height'])
 
             elif b['hashPrev'] == GENESIS_HASH_PREV:
                 in_longest = 1  # Assume only one genesis block per chain.  XXX
@@ -2307,6 +2784,7 @@ store._ddl['txout_approx'],
                 UPDATE chain
                    SET chain_last_block_id = ?
                  WHERE chain_id = ?""", (b['block_id'], chain_id))
+            store._blocks.set_main(chain_id, b['height'], b['block_id'])
 
         if store.use_firstbits and b['height'] is not None:
             (addr_vers,) = store.selectrow("""
@@ -2332,25 +2810,137 @@ store._ddl['txout_approx'],
         return frozenset(ret)
 
     def get_prev_block_id(store, block_id):
+        if store._load_block(block_id) is not None:
+            return store._blocks.prev_id(block_id)
         return store.selectrow(
             "SELECT prev_block_id FROM block WHERE block_id = ?",
             (block_id,))[0]
 
+    def reorganize(store, chain_id, loser_id, loser_height,
+                   winner_id, winner_height):
+        """
+        Move the chain's longest chain from the loser block to the
+        winner.  Return the number of blocks disconnected and
+        connected.
+        """
+        to_connect = []
+        to_disconnect = []
+        while loser_height > winner_height:
+            to_disconnect.append(loser_id)
+            loser_id = store.get_prev_block_id(loser_id)
+            loser_height -= 1
+        while winner_height > loser_height:
+            to_connect.append(winner_id)
+            winner_id = store.get_prev_block_id(winner_id)
+            winner_height -= 1
+        while loser_id <> winner_id:
+            to_disconnect.append(loser_id)
+            loser_id = store.get_prev_block_id(loser_id)
+            to_connect.append(winner_id)
+            winner_id = store.get_prev_block_id(winner_id)
+        to_connect.reverse()
+        store.disconnect_blocks(to_disconnect, chain_id)
+        store.connect_blocks(to_connect, chain_id)
+        return len(to_disconnect), len(to_connect)
+
+    def _set_in_longest(store, block_ids, chain_id, in_longest):
+        for i in xrange(0, len(block_ids), ID_LIST_MAX):
+            chunk = block_ids[i : i + ID_LIST_MAX]
+            store.sql("""
+                UPDATE chain_candidate
+                   SET in_longest = ?
+                 WHERE chain_id = ?
+                   AND block_id IN (""" + ", ".join(["?"] * len(chunk)) +
+                      ")", [in_longest, chain_id] + chunk)
+
+    def disconnect_blocks(store, block_ids, chain_id):
+        store._set_in_longest(block_ids, chain_id, 0)
+        for block_id in block_ids:
+            height = store._load_block(block_id)
+            if store._blocks.main_block_id(chain_id, height) == block_id:
+                store._blocks.set_main(chain_id, height, None)
+
+    def connect_blocks(store, block_ids, chain_id):
+        store._set_in_longest(block_ids, chain_id, 1)
+        for block_id in block_ids:
+            store._blocks.set_main(chain_id, store._load_block(block_id),
+                                   block_id)
+
     def disconnect_block(store, block_id, chain_id):
-        store.sql("""
-            UPDATE chain_candidate
-               SET in_longest = 0
-             WHERE block_id = ? AND chain_id = ?""",
-                  (block_id, chain_id))
+        store.disconnect_blocks([block_id], chain_id)
 
     def connect_block(store, block_id, chain_id):
-        store.sql("""
-            UPDATE chain_candidate
-               SET in_longest = 1
-             WHERE block_id = ? AND chain_id = ?""",
-                  (block_id, chain_id))
+        store.connect_blocks([block_id], chain_id)
+
+    def main_chain_height(store, chain_id):
+        """
+        Return the height of the chain's last block, or None if it has
+        none, first bringing the longest-chain index up to date with
+        blocks other processes may have loaded.
+        """
+        row = store.selectrow("""
+            SELECT b.block_id, b.block_height
+              FROM block b
+              JOIN chain c ON (c.chain_last_block_id = b.block_id)
+             WHERE c.chain_id = ?""", (chain_id,))
+        if row is None or row[1] is None:
+            return None
+        block_id, top = int(row[0]), int(row[1])
+        blocks = store._blocks
+
+        # Walk down from the top until the index agrees.  These blocks
+        # are committed, so a rollback need not forget them.
+        with store._load_lock:
+            blocks.truncate_main(chain_id, top + 1)
+            height = top
+            while block_id is not None and \
+                    blocks.main_block_id(chain_id, height) != block_id:
+                store._load_block(block_id)
+                blocks.set_main(chain_id, height, block_id, pending=False)
+                block_id = blocks.prev_id(block_id)
+                height -= 1
+        return top
+
+    def main_chain_block_id(store, chain_id, height):
+        """
+        Return the ID of the chain's longest-chain block at height, or
+        None.  Call main_chain_height first to see recent blocks.
+        """
+        return store._blocks.main_block_id(chain_id, height)
+
+    def select_main_chain_blocks(store, chain_id, columns, heights):
+        """
+        Return a row of the given expressions over block b for each
+        longest-chain block at the given heights, in the same order,
+        or None if the block index lacks any of them.  Call
+        main_chain_height first to see recent blocks.
+        """
+        block_ids = []
+        for height in heights:
+            block_id = store._blocks.main_block_id(chain_id, height)
+            if block_id is None:
+                return None
+            block_ids.append(block_id)
+
+        found = {}
+        for i in xrange(0, len(block_ids), ID_LIST_MAX):
+            chunk = block_ids[i : i + ID_LIST_MAX]
+            for row in store.selectall("""
+                SELECT b.block_id, """ + columns + """
+                  FROM block b
+                 WHERE b.block_id IN (""" + ", ".join(["?"] * len(chunk)) +
+                                       ")", chunk):
+                found[int(row[0])] = row[1:]
+        if len(found) < len(set(block_ids)):
+            # The index changed under us; let the caller use SQL.
+            return None
+        return [found[block_id] for block_id in block_ids]
 
     def lookup_txout(store, tx_hash, txout_pos):
+        key = (tx_hash, txout_pos)
+        ret = store._txout_cache.get(key)
+        if ret is not None:
+            return ret
         row = store.selectrow("""
             SELECT txout.txout_id, txout.txout_value
               FROM txout, tx
@@ -2358,7 +2948,11 @@ store._ddl['txout_approx'],
                AND tx.tx_hash = ?
                AND txout.txout_pos = ?""",
                   (store.hashin(tx_hash), txout_pos))
-        return (None, None) if row is None else (row[0], int(row[1]))
+        if row is None:
+            return (None, None)
+        ret = (row[0], int(row[1]))
+        store._txout_cache.put(key, ret)
+        return ret
 
     def script_to_pubkey_id(store, script):
         """Extract address from transaction output script."""
@@ -2406,27 +3000,206 @@ store._ddl['txout_approx'],
         return store._pubkey_id(pubkey_hash, pubkey)
 
     def _pubkey_id(store, pubkey_hash, pubkey):
+        pubkey_id = store._pubkey_cache.get(pubkey_hash)
+        if pubkey_id is not None:
+            return pubkey_id
         dbhash = store.binin(pubkey_hash)  # binin, not hashin for 160-bit
         row = store.selectrow("""
             SELECT pubkey_id
               FROM pubkey
              WHERE pubkey_hash = ?""", (dbhash,))
         if row:
-            return row[0]
-        pubkey_id = store.new_id("pubkey")
-        store.sql("""
-            INSERT INTO pubkey (pubkey_id, pubkey_hash, pubkey)
-            VALUES (?, ?, ?)""",
-                  (pubkey_id, dbhash, store.binin(pubkey)))
+            pubkey_id = row[0]
+        else:
+            pubkey_id = store.new_id("pubkey")
+            store.sql("""
+                INSERT INTO pubkey (pubkey_id, pubkey_hash, pubkey)
+                VALUES (?, ?, ?)""",
+                      (pubkey_id, dbhash, store.binin(pubkey)))
+        # Until the next commit, rollback removes this entry.
+        store._pubkey_cache.put(pubkey_hash, pubkey_id)
         return pubkey_id
 
+    def bulk_load(store):
+        """
+        Load all block files with the indexes in BULK_LOAD_INDEXES
+        dropped and foreign key checks off, committing rarely, then
+        restore them.  If loading fails, the next end_bulk_load
+        restores them.  configvar bulk_loader names the loading
+        process meanwhile, so that others leave them alone.
+        """
+        pid = store.get_lock_pid()
+        if pid is not None and pid != os.getpid() and \
+                util.process_is_alive(pid):
+            raise Exception(
+                "Process %d holds abe_lock; stop it before bulk loading"
+                % (pid,))
+        # SQLite locks the whole database while loading anyway.
+        lock = None
+        if not hasattr(store.module, "sqlite_version"):
+            lock = store.get_lock()
+        try:
+            store.set_configvar("bulk_loader", "%s %d" % (
+                    socket.gethostname(), os.getpid()))
+            store.commit()
+            store._begin_bulk_load()
+            for dircfg in store.datadirs:
+                store.catch_up_dir(dircfg)
+            store.end_bulk_load()
+        finally:
+            store.release_lock(lock)
+
+    def _begin_bulk_load(store):
+        store.bulk_loading = True
+        store.commit_bytes = max(store.commit_bytes, BULK_LOAD_COMMIT_BYTES)
+        store.commit_sched.max_bytes = store.commit_bytes
+
+        store.commit()
+        if hasattr(store.module, "sqlite_version"):
+            # SQLite does not check foreign keys by default.  A crash
+            # without synchronous writes may corrupt the database.
+            store.sql("PRAGMA synchronous = OFF")
+        elif store.module.__name__ == "MySQLdb":
+            store.sql("SET foreign_key_checks = 0")
+        elif store.module.__name__ == "psycopg2":
+            for table, name, definition in store.selectall("""
+                SELECT cl.relname, co.conname, pg_get_constraintdef(co.oid)
+                  FROM pg_constraint co
+                  JOIN pg_class cl ON (co.conrelid = cl.oid)
+                 WHERE co.contype = 'f'
+                   AND cl.relname IN (""" + ", ".join(
+                    ["?"] * len(BULK_LOAD_FK_TABLES)) + ")",
+                                                   BULK_LOAD_FK_TABLES):
+                store.ddl("ALTER TABLE %s DROP CONSTRAINT %s" % (table, name))
+                store.set_configvar(
+                    "bulk_load_fk %s %s" % (table, name), definition)
+                store.commit()
+                store.log.info("Dropped constraint %s on %s", name, table)
+
+        for name, table in BULK_LOAD_INDEXES:
+            if ("bulk_load_index " + name) in store.config:
+                continue
+            try:
+                if store.module.__name__ == "MySQLdb":
+                    store.ddl("DROP INDEX %s ON %s" % (name, table))
+                else:
+                    store.ddl("DROP INDEX " + name)
+            except store.module.DatabaseError, e:
+                # MySQL refuses to drop an index that a foreign key uses.
+                store.rollback()
+                store.log.warning("Keeping index %s: %s", name, e)
+                continue
+            store.set_configvar("bulk_load_index " + name, table)
+            store.commit()
+            store.log.info("Dropped index %s", name)
+
+    def end_bulk_load(store):
+        """
+        Create the indexes and constraints that an unfinished bulk
+        load dropped.  Does nothing if there are none, or if another
+        process may still be bulk loading.
+        """
+        if not store.bulk_loading:
+            # Another process may have started or finished a bulk
+            # load since we read the configuration.
+            store._reread_bulk_load_config()
+            loader = store.config.get("bulk_loader")
+            if loader is not None and store._bulk_loader_alive(loader):
+                store.log.warning(
+                    "Bulk load by %s may be running; not restoring its"
+                    " indexes.  If it is not, run --bulk-load again.", loader)
+                return
+
+        pending = sorted(name for name in store.config.keys()
+                         if name.startswith("bulk_load_"))
+        # Create indexes before foreign keys, which check by them.
+        pending.sort(key=lambda name: not name.startswith("bulk_load_index"))
+
+        if store.bulk_loading:
+            store.bulk_loading = False
+            store.commit_bytes = store._args_commit_bytes()
+            store.commit_sched.max_bytes = store.commit_bytes
+            store.commit()
+            if hasattr(store.module, "sqlite_version"):
+                store.sql("PRAGMA synchronous = FULL")
+            elif store.module.__name__ == "MySQLdb":
+                store.sql("SET foreign_key_checks = 1")
+
+        for i, name in enumerate(pending):
+            words = name.split(" ")
+            store.log.info("Bulk load: restoring %s (%d of %d)",
+                           " ".join(words[1:]), i + 1, len(pending))
+            if words[0] == "bulk_load_index":
+                store.ddl(store._ddl[words[1]])
+            else:
+                store.ddl("ALTER TABLE %s ADD CONSTRAINT %s %s"
+                          % (words[1], words[2], store.config[name]))
+            store.sql("DELETE FROM configvar WHERE configvar_name = ?",
+                      (name,))
+            del store.config[name]
+            store.commit()
+        if pending:
+            store.log.info("Bulk load: indexes and constraints restored")
+        if "bulk_loader" in store.config:
+            store.sql("DELETE FROM configvar WHERE configvar_name = ?",
+                      ("bulk_loader",))
+            del store.config["bulk_loader"]
+            store.commit()
+
+    def _reread_bulk_load_config(store):
+        rows = dict(store.selectall("""
+            SELECT configvar_name, configvar_value
+              FROM configvar
+             WHERE configvar_name LIKE 'bulk_load%'"""))
+        for name in store.config.keys():
+            if name.startswith("bulk_load") and name not in rows:
+                del store.config[name]
+        store.config.update(rows)
+
+    def _bulk_loader_alive(store, loader):
+        host, pid = loader.rsplit(" ", 1)
+        if host != socket.gethostname():
+            return True  # We cannot tell.
+        return util.process_is_alive(int(pid))
+
     def catch_up(store):
+        """Load new blocks.  Return false if any datadir failed."""
+        # One thread at a time loads, on the store's own connection.
+        with store._load_lock:
+            pooled = store._local.__dict__.copy()
+            store._local.__dict__.clear()
+            try:
+                return store._catch_up()
+            finally:
+                store._local.__dict__.update(pooled)
+
+    def _catch_up(store):
+        ok = True
+        # Another process may have loaded inputs without their outputs.
+        store._unlinked_txins = None
+        for (chain_id,) in store.selectall("SELECT chain_id FROM chain"):
+            store.main_chain_height(chain_id)
         for dircfg in store.datadirs:
             try:
                 store.catch_up_dir(dircfg)
             except Exception, e:
                 store.log.exception("Failed to catch up %s", dircfg)
                 store.rollback()
+                ok = False
+        return ok
+
+    def save_catch_up_time(store, nTime):
+        """Record when a periodic loader last caught up."""
+        store.set_configvar('catch_up_time', str(int(nTime)))
+        store.commit()
+
+    def get_catch_up_time(store):
+        """Return the time recorded by save_catch_up_time, or None."""
+        row = store.selectrow("""
+            SELECT configvar_value
+              FROM configvar
+             WHERE configvar_name = 'catch_up_time'""")
+        return None if row is None else int(row[0])
 
     # Load all blocks starting at the current file and offset.
     def catch_up_dir(store, dircfg):
@@ -2434,9 +3207,13 @@ store._ddl['txout_approx'],
 
         def open_blkfile():
             store._refresh_dircfg(dircfg)
+            filename[0] = store.blkfile_name(dircfg)
+            if store.follow_blkfiles:
+                ds = store._followed_blkfile(dircfg, filename[0])
+                if ds is not None:
+                    return ds
             ds = BCDataStream.BCDataStream()
 
-            filename[0] = store.blkfile_name(dircfg)
             try:
                 file = open(filename[0], "rb")
             except IOError, e:
@@ -2455,16 +3232,14 @@ store._ddl['txout_approx'],
                 dircfg['blkfile_number'] = new_number
 
             try:
-                ds.map_file(file, 0)
+                store._map_blkfile(ds, file)
             except:
-                # mmap can fail on an empty file, but empty files are okay.
-                file.seek(0, os.SEEK_END)
-                if file.tell() == 0:
-                    ds.input = ""
-                    ds.read_cursor = 0
-                else:
-                    ds.map_file(file, 0)
-            finally:
+                file.close()
+                raise
+            if store.follow_blkfiles:
+                # Keep the file open to map what bitcoind appends.
+                store._followed[dircfg['id']] = (filename[0], file, ds)
+            else:
                 file.close()
             return ds
 
@@ -2475,16 +3250,23 @@ store._ddl['txout_approx'],
             return
 
         while True:
+            # Move on only if the next file existed before we read this
+            # one to the end, since bitcoind may still be adding to it.
+            next_exists = os.path.exists(store.blkfile_name(
+                    dircfg, dircfg['blkfile_number'] + 1))
             try:
                 store.import_blkdat(dircfg, ds, filename[0])
             except:
                 store.log.warning("Exception at %d" % ds.read_cursor)
                 raise
             finally:
-                try:
-                    ds.close_file()
-                except:
-                    pass
+                if not store.follow_blkfiles:
+                    try:
+                        ds.close_file()
+                    except:
+                        pass
+            if not next_exists:
+                return
 
             # Try another file.
             dircfg['blkfile_number'] += 1
@@ -2499,42 +3281,282 @@ store._ddl['txout_approx'],
 
             dircfg['blkfile_offset'] = 0
 
+    def _map_blkfile(store, ds, file):
+        try:
+            ds.map_file(file, 0)
+        except:
+            # mmap can fail on an empty file, but empty files are okay.
+            file.seek(0, os.SEEK_END)
+            if file.tell() == 0:
+                ds.input = ""
+                ds.read_cursor = 0
+            else:
+                ds.map_file(file, 0)
+
+    def _followed_blkfile(store, dircfg, filename):
+        """
+        Return the data stream of the block file kept open for
+        dircfg, mapping any bytes appended since it was last mapped,
+        or None if it is not the named file.
+        """
+        entry = store._followed.get(dircfg['id'])
+        if entry is None:
+            return None
+        name, file, ds = entry
+        try:
+            same = (name == filename and os.stat(filename).st_ino ==
+                    os.fstat(file.fileno()).st_ino)
+        except OSError:
+            same = False
+        if not same:
+            store._unfollow_blkfile(dircfg['id'])
+            return None
+
+        size = os.fstat(file.fileno()).st_size
+        if size != len(ds.input):
+            if ds.input != "":
+                ds.close_file()
+            store._map_blkfile(ds, file)
+        return ds
+
+    def _unfollow_blkfile(store, datadir_id):
+        name, file, ds = store._followed.pop(datadir_id)
+        if ds.input != "":
+            ds.close_file()
+        file.close()
+
+    def wait_for_blocks(store, timeout):
+        """
+        Sleep for timeout seconds.  If following block files, wake
+        up early when one changes.
+        """
+        if not store.follow_blkfiles:
+            time.sleep(timeout)
+            return
+        if store._watcher is None:
+            import follow
+            store._watcher = follow.BlockFileWatcher(
+                [dircfg['dirname'] for dircfg in store.datadirs])
+            store.log.info("Watching block files %s",
+                           "with inotify" if store._watcher.uses_inotify()
+                           else "by polling")
+        store._watcher.wait(timeout)
+
     # Load all blocks from the given data stream.
     def import_blkdat(store, dircfg, ds, filename="[unknown]"):
         filenum = dircfg['blkfile_number']
         ds.read_cursor = dircfg['blkfile_offset']
         bytes_done = 0
+        header_hash = store._header_hasher(ds, filename)
+        pool = orphanpool.OrphanPool(store.orphan_pool_bytes)
+        file_changed = False
+
+        if store.pipeline_depth > 0:
+            # Read, parse and hash ahead in another thread.  This
+            # thread alone uses the database.
+            magic_chains = store._magic_chain_ids()
+            records = store._pipeline(store._scan_blkdat(
+                    dircfg, ds, filename, header_hash,
+                    lambda magic: magic_chains.get(magic), True))
+        else:
+            records = store._scan_blkdat(
+                dircfg, ds, filename, header_hash,
+                store._chain_id_for_magic, False)
+
+        try:
+            for record in records:
+                if record[0] == "end":
+                    ds.read_cursor = record[1]
+                    break
+                (kind, offset, chain_id, magic, length, end, hash, b,
+                 parsed_end) = record
+
+                block_row = store.selectrow("""
+                    SELECT block_id, block_height, block_chain_work,
+                           block_nTime, block_total_seconds,
+                           block_total_satoshis, block_satoshi_seconds
+                      FROM block
+                     WHERE block_hash = ?
+                """, (store.hashin(hash),))
+
+                if block_row:
+                    # Block header already seen.  Don't import the block,
+                    # but try to add it to the chain.
+                    if chain_id is not None:
+                        b = {
+                            "block_id":   block_row[0],
+                            "height":     block_row[1],
+                            "chain_work": store.binout_int(block_row[2]),
+                            "nTime":      block_row[3],
+                            "seconds":    block_row[4],
+                            "satoshis":   block_row[5],
+                            "ss":         block_row[6]}
+                        if store.selectrow("""
+                            SELECT 1
+                              FROM chain_candidate
+                             WHERE block_id = ?
+                               AND chain_id = ?""",
+                                        (b['block_id'], chain_id)):
+                            store.log.info("block %d already in chain %d",
+                                           b['block_id'], chain_id)
+                            b = None
+                        else:
+                            if b['height'] == 0:
+                                b['hashPrev'] = GENESIS_HASH_PREV
+                            else:
+                                b['hashPrev'] = 'dummy'  # Fool adopt_orphans.
+                            store.offer_block_to_chains(b, frozenset([chain_id]))
+                elif hash in pool:
+                    store.log.info("block %s already awaiting its parent",
+                                   hash[::-1].encode('hex'))
+                else:
+                    if b is None:
+                        ds.read_cursor = offset + 8
+                        b = store.parse_block(ds, chain_id, magic, length)
+                        parsed_end = ds.read_cursor
+                    b["hash"] = hash
+                    chain_ids = frozenset([] if chain_id is None else [chain_id])
+                    store._import_or_pool(pool, offset, length, b, chain_ids)
+                    if parsed_end != end:
+                        store.log.debug("Skipped %d bytes at block end",
+                                        end - parsed_end)
+
+                ds.read_cursor = end
+
+                bytes_done += length
+                store.commit_sched.add(nbytes=length)
+                if store.commit_sched.due():
+                    if store.bulk_loading:
+                        store.log.info("Bulk load: %s %d%%", filename,
+                                       100 * ds.read_cursor / len(ds.input))
+                    # Resume no later than the first block still
+                    # waiting for its parent.
+                    oldest = pool.oldest()
+                    store.save_blkfile_offset(
+                        dircfg, ds.read_cursor if oldest is None
+                        else oldest[0])
+                    store.commit()
+                    store._refresh_dircfg(dircfg)
+                    bytes_done = 0
+                    if filenum != dircfg['blkfile_number']:
+                        file_changed = True
+                        break
+        finally:
+            records.close()
 
-        while filenum == dircfg['blkfile_number']:
-            if ds.read_cursor + 8 > len(ds.input):
+        if file_changed:
+            # Another process has read past this file, pooled blocks
+            # included, and the saved offset is now its own.
+            return
+
+        if len(pool) > 0:
+            store.log.info("Importing %d blocks without their parents",
+                           len(pool))
+            while len(pool) > 0:
+                store._import_pooled(pool, pool.pop_oldest())
+            bytes_done += 1
+
+        if bytes_done > 0:
+            store.save_blkfile_offset(dircfg, ds.read_cursor)
+            store.commit()
+
+    def _import_or_pool(store, pool, offset, length, b, chain_ids):
+        """
+        Import block b, or if its parent has yet to be imported, hold
+        it in the pool until then.
+        """
+        if pool.max_bytes > 0 and not store._parent_imported(pool, b):
+            pool.add(b['hash'], b['hashPrev'], length, (offset, b, chain_ids))
+            while pool.full():
+                # Make room by importing an orphan the old way.
+                store._import_pooled(pool, pool.pop_oldest())
+            return
+        store._import_pooled(pool, (offset, b, chain_ids))
+
+    def _parent_imported(store, pool, b):
+        hashPrev = b['hashPrev']
+        if hashPrev == GENESIS_HASH_PREV or hashPrev == pool.last_imported:
+            return True
+        return store.selectrow("""
+            SELECT 1
+              FROM block
+             WHERE block_hash = ?""", (store.hashin(hashPrev),)) is not None
+
+    def _import_pooled(store, pool, item):
+        """Import a block and then any pooled descendants."""
+        items = [item]
+        while items:
+            offset, b, chain_ids = items.pop(0)
+            store.import_block(b, chain_ids = chain_ids)
+            pool.last_imported = b['hash']
+            items += pool.pop_children(b['hash'])
+
+    def _chain_id_for_magic(store, magic):
+        rows = store.selectall("""
+            SELECT chain.chain_id
+              FROM chain
+              JOIN magic ON (chain.magic_id = magic.magic_id)
+             WHERE magic.magic = ?""",
+                               (store.binin(magic),))
+        if len(rows) == 1:
+            return rows[0][0]
+        return None
+
+    def _magic_chain_ids(store):
+        """Return a dict mapping each magic number used by exactly
+        one chain to that chain's ID."""
+        chain_ids = {}
+        for magic, chain_id in store.selectall("""
+            SELECT magic.magic, chain.chain_id
+              FROM chain
+              JOIN magic ON (chain.magic_id = magic.magic_id)"""):
+            magic = store.binout(magic)
+            chain_ids[magic] = None if magic in chain_ids else chain_id
+        return chain_ids
+
+    def _scan_blkdat(store, dircfg, ds, filename, header_hash,
+                     chain_id_for_magic, parse):
+        """
+        Generate the block records in ds.input from ds.read_cursor on
+        as tuples ("block", offset, chain_id, magic, length, end, hash,
+        b, parsed_end), where b and parsed_end are None unless parse
+        is true.  The last tuple is ("end", offset) with the offset at
+        which to resume.  Does not move ds.read_cursor.
+        """
+        rds = BCDataStream.BCDataStream()
+        rds.input = ds.input
+        rds.read_cursor = ds.read_cursor
+
+        while True:
+            if rds.read_cursor + 8 > len(rds.input):
                 break
 
-            offset = ds.read_cursor
-            magic = ds.read_bytes(4)
+            offset = rds.read_cursor
+            magic = rds.read_bytes(4)
 
             # Assume blocks obey the respective policy if they get here.
             chain_id = dircfg['chain_id']
             if chain_id is None:
-                rows = store.selectall("""
-                    SELECT chain.chain_id
-                      FROM chain
-                      JOIN magic ON (chain.magic_id = magic.magic_id)
-                     WHERE magic.magic = ?""",
-                                       (store.binin(magic),))
-                if len(rows) == 1:
-                    chain_id = rows[0][0]
+                chain_id = chain_id_for_magic(magic)
             if chain_id is None:
                 if magic[0] == chr(0):
                     # Skip NUL bytes at block end.
-                    ds.read_cursor = offset
-                    while ds.read_cursor < len(ds.input):
-                        size = min(len(ds.input) - ds.read_cursor, 1000)
-                        data = ds.read_bytes(size).lstrip("\0")
+                    rds.read_cursor = offset
+                    while rds.read_cursor < len(rds.input):
+                        size = min(len(rds.input) - rds.read_cursor, 1000)
+                        data = rds.read_bytes(size).lstrip("\0")
                         if (data != ""):
-                            ds.read_cursor -= len(data)
+                            rds.read_cursor -= len(data)
                             break
+                    if rds.read_cursor >= len(rds.input):
+                        # bitcoind may have allocated space for blocks
+                        # it has yet to write.  Resume at the NULs.
+                        store.log.debug("NUL bytes to end of file at %d",
+                                        offset)
+                        rds.read_cursor = offset
+                        break
                     store.log.info("Skipped %d NUL bytes at block end",
-                                   ds.read_cursor - offset)
+                                   rds.read_cursor - offset)
                     continue
 
                 store.log.error(
@@ -2543,82 +3565,242 @@ store._ddl['txout_approx'],
                     " forcing a rescan: UPDATE datadir SET blkfile_number=1,"
                     " blkfile_offset=0 WHERE dirname='%s'",
                     repr(magic), filename, offset, dircfg['dirname'])
-                ds.read_cursor = offset
+                rds.read_cursor = offset
                 break
 
-            length = ds.read_int32()
-            if ds.read_cursor + length > len(ds.input):
+            length = rds.read_int32()
+            if rds.read_cursor + length > len(rds.input):
                 store.log.debug("incomplete block of length %d chain %d",
                                 length, chain_id)
-                ds.read_cursor = offset
+                rds.read_cursor = offset
                 break
-            end = ds.read_cursor + length
-            #block_header = ds.input[ds.read_cursor : ds.read_cursor + 80]
-            #block_nTime = ds.input[ds.read_cursor + 68 : ds.read_cursor + 4]
-            hash = util.scrypt(
-                ds.input[ds.read_cursor : ds.read_cursor + 80])
+            end = rds.read_cursor + length
+            hash = header_hash(rds.read_cursor)
             # XXX should decode target and check hash against it to
             # avoid loading garbage data.  But not for merged-mined or
             # CPU-mined chains that use different proof-of-work
             # algorithms.  Time to resurrect policy_id?
 
-            block_row = store.selectrow("""
-                SELECT block_id, block_height, block_chain_work,
-                       block_nTime, block_total_seconds,
-                       block_total_satoshis, block_satoshi_seconds
-                  FROM block
-                 WHERE block_hash = ?
-            """, (store.hashin(hash),))
-
-            if block_row:
-                # Block header already seen.  Don't import the block,
-                # but try to add it to the chain.
-                if chain_id is not None:
-                    b = {
-                        "block_id":   block_row[0],
-                        "height":     block_row[1],
-                        "chain_work": store.binout_int(block_row[2]),
-                        "nTime":      block_row[3],
-                        "seconds":    block_row[4],
-                        "satoshis":   block_row[5],
-                        "ss":         block_row[6]}
-                    if store.selectrow("""
-                        SELECT 1
-                          FROM chain_candidate
-                         WHERE block_id = ?
-                           AND chain_id = ?""",
-                                    (b['block_id'], chain_id)):
-                        store.log.info("block %d already in chain %d",
-                                       b['block_id'], chain_id)
-                        b = None
-                    else:
-                        if b['height'] == 0:
-                            b['hashPrev'] = GENESIS_HASH_PREV
-                        else:
-                            b['hashPrev'] = 'dummy'  # Fool adopt_orphans.
-                        store.offer_block_to_chains(b, frozenset([chain_id]))
+            b = None
+            parsed_end = None
+            if parse:
+                b = store.parse_block(rds, chain_id, magic, length)
+                parsed_end = rds.read_cursor
+
+            yield ("block", offset, chain_id, magic, length, end, hash, b,
+                   parsed_end)
+            rds.read_cursor = end
+
+        yield ("end", rds.read_cursor)
+
+    def _pipeline(store, items):
+        """
+        Run the generator items in a new thread, and generate its
+        items in order through a queue of at most pipeline_depth
+        items.  An exception in the thread is raised where its item
+        would have been.  Closing the returned generator stops the
+        thread.
+        """
+        import sys
+        import threading
+        import Queue
+
+        queue = Queue.Queue(store.pipeline_depth)
+        stop = threading.Event()
+
+        def put(entry):
+            while not stop.is_set():
+                try:
+                    queue.put(entry, True, 0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def run():
+            try:
+                for item in items:
+                    if not put((item, None)):
+                        return
+            except Exception:
+                put((None, sys.exc_info()))
+                return
+            put((None, None))
+
+        thread = threading.Thread(target=run, name="blkfile reader")
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item, exc_info = queue.get()
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if item is None:
+                    return
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def _get_hash_pool(store):
+        """
+        Return the pool of hash_workers workers, starting it if
+        necessary.  Where ybc_scrypt can hash without holding the GIL,
+        the workers are threads, otherwise processes.
+        """
+        if store._hash_pool is None:
+            if util.getPoWHashes is None:
+                import multiprocessing
+                store._hash_pool = multiprocessing.Pool(store.hash_workers)
+                kind = "processes"
             else:
-                b = store.parse_block(ds, chain_id, magic, length)
-                b["hash"] = hash
-                chain_ids = frozenset([] if chain_id is None else [chain_id])
-                store.import_block(b, chain_ids = chain_ids)
-                if ds.read_cursor != end:
-                    store.log.debug("Skipped %d bytes at block end",
-                                    end - ds.read_cursor)
-
-            ds.read_cursor = end
-
-            bytes_done += length
-            if bytes_done >= store.commit_bytes:
-                store.log.debug("commit")
-                store.save_blkfile_offset(dircfg, ds.read_cursor)
-                store.commit()
-                store._refresh_dircfg(dircfg)
-                bytes_done = 0
+                from multiprocessing.pool import ThreadPool
+                store._hash_pool = ThreadPool(store.hash_workers)
+                kind = "threads"
+            store.log.info("Started %d hash worker %s",
+                           store.hash_workers, kind)
+        return store._hash_pool
+
+    def hash_headers(store, headers):
+        """Return the proof-of-work hashes of a list of 80-byte headers."""
+        if store.hash_workers <= 0:
+            return util.scrypt_headers(headers)
+        batches = [headers[i : i + HASH_BATCH]
+                   for i in xrange(0, len(headers), HASH_BATCH)]
+        ret = []
+        for hashes in store._get_hash_pool().imap(util.scrypt_headers,
+                                                  batches):
+            ret += hashes
+        return ret
 
-        if bytes_done > 0:
-            store.save_blkfile_offset(dircfg, ds.read_cursor)
-            store.commit()
+    def _get_hash_cache(store, filename):
+        """
+        Return the sidecar hash cache of the named block file, or None
+        if hash_cache is off or the sidecar can not be used.
+        """
+        if not store.hash_cache or filename == "[unknown]":
+            return None
+        if filename not in store._hash_caches:
+            import hashcache
+            cache_file = filename + hashcache.SUFFIX
+            try:
+                cache = hashcache.HeaderHashCache(cache_file)
+            except (IOError, OSError), e:
+                store.log.warning("Not caching header hashes in %s: %s",
+                                  cache_file, e)
+                cache = None
+            store._hash_caches[filename] = cache
+        return store._hash_caches[filename]
+
+    def _header_hasher(store, ds, filename="[unknown]"):
+        """
+        Return a function that maps the offset of a block header in
+        ds.input to the header's proof-of-work hash.  If hash_workers
+        is set, a pool hashes the headers that follow ds.read_cursor
+        while the caller imports earlier blocks.  Results are consumed
+        in file order.  If hash_cache is set, hashes are looked up in
+        and added to the block file's sidecar.
+        """
+        cache = store._get_hash_cache(filename)
+
+        def hash_inline(pos):
+            return util.scrypt(ds.input[pos : pos + 80])
+
+        if store.hash_workers <= 0:
+            hash_new = hash_inline
+        else:
+            hash_new = store._pooled_hasher(ds, cache, hash_inline)
+
+        if cache is None:
+            return hash_new
+
+        def header_hash(pos):
+            header = ds.input[pos : pos + 80]
+            hash = cache.get(pos, header)
+            if hash is None:
+                hash = hash_new(pos)
+                cache.put(pos, header, hash)
+            return hash
+
+        return header_hash
+
+    def _pooled_hasher(store, ds, cache, hash_inline):
+        pool = store._get_hash_pool()
+        window = max(1, store.hash_workers * HASH_AHEAD / HASH_BATCH)
+        headers = store._iter_block_headers(ds, ds.read_cursor)
+        if cache is not None:
+            headers = (item for item in headers
+                       if cache.get(*item) is None)
+
+        def submit(batch):
+            return ([offset for offset, header in batch],
+                    pool.apply_async(util.scrypt_headers,
+                                     ([header for offset, header in batch],)))
+
+        def hashed():
+            pending = collections.deque()
+            batch = []
+            for item in headers:
+                batch.append(item)
+                if len(batch) < HASH_BATCH:
+                    continue
+                pending.append(submit(batch))
+                batch = []
+                if len(pending) >= window:
+                    offsets, result = pending.popleft()
+                    for item in zip(offsets, result.get()):
+                        yield item
+            if batch:
+                pending.append(submit(batch))
+            for offsets, result in pending:
+                for item in zip(offsets, result.get()):
+                    yield item
+
+        results = hashed()
+        ahead = [None]
+
+        def header_hash(pos):
+            item = ahead[0]
+            while item is None or item[0] < pos:
+                item = next(results, None)
+                if item is None:
+                    break
+            ahead[0] = item
+
+            # The caller may ask for a header we never scanned, for
+            # example after skipping a span we could not parse.
+            if item is None or item[0] != pos:
+                return hash_inline(pos)
+            ahead[0] = None
+            return item[1]
+
+        return header_hash
+
+    def _iter_block_headers(store, ds, offset):
+        """
+        Yield (offset, header) for each complete block record in
+        ds.input starting at offset, where offset is that of the
+        80-byte header.  Does not move ds.read_cursor.  Stops where
+        import_blkdat would stop to wait for more data.
+        """
+        input = ds.input
+        while offset + 8 <= len(input):
+            if input[offset] == "\0":
+                # Skip NUL bytes at block end as import_blkdat does.
+                while offset < len(input):
+                    data = input[offset : offset + 1000]
+                    stripped = data.lstrip("\0")
+                    offset += len(data) - len(stripped)
+                    if stripped != "":
+                        break
+                continue
+
+            (length,) = struct.unpack_from('<i', input, offset + 4)
+            offset += 8
+            if length < 80 or offset + length > len(input):
+                return
+            yield offset, input[offset : offset + 80]
+            offset += length
 
     def parse_block(store, ds, chain_id=None, magic=None, length=None):
         d = deserialize.parse_BlockHeader(ds)
@@ -2641,7 +3823,7 @@ store._ddl['txout_approx'],
             number = dircfg['blkfile_number']
         #if number > 9999:
         #    return os.path.join(dircfg['dirname'], "blocks", "blk-v1-%05d.dat" % (number - 100000,))
-        return os.path.join(dircfg['dirname'], "blk-v1-0001.dat")
+        return os.path.join(dircfg['dirname'], "blk-v1-%04d.dat" % (number,))
 
     def save_blkfile_offset(store, dircfg, offset):
         store.sql("""
@@ -2885,5 +4067,5 @@ store._ddl['txout_approx'],
                 ret = fb
         return ret
 
-def new(args):
-    return DataStore(args)
+def new(args, block_index_file=None):
+    return DataStore(args, block_index_file)
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+# -*- coding: utf-8 -*-
 # Copyright(C) 2011,2012 by John Tobey <John.Tobey@gmail.com>
 
 # This program is free software: you can redistribute it and/or modify
@@ -29,6 +30,7 @@ import json
 import version
 import DataStore
 import readconf
+import sqlstats
 
 # bitcointools -- modified deserialize.py to return raw transaction
 import deserialize
@@ -77,6 +79,7 @@ DEFAULT_TEMPLATE = """
         <!-- <a href="%(dotdot)saddress/%(DONATIONS_BTC)s">BTC</a> -->
         <a href="%(dotdot)saddress/%(DONATIONS_YBC)s">YBC</a>
     </p>
+    %(data_age)s
 </body>
 </html>
 """
@@ -116,11 +119,64 @@ START DATA
 # How many addresses to accept in /unspent/ADDR|ADDR|...
 MAX_UNSPENT_ADDRESSES = 200
 
+# Defaults for --server=threaded and --server=prefork.
+DEFAULT_WORKERS = 4
+DEFAULT_REQUEST_TIMEOUT = 30
+DEFAULT_KEEPALIVE_TIMEOUT = 5
+
+# Default seconds between loads for --server=threaded and prefork.
+DEFAULT_CATCH_UP_INTERVAL = 10
+
 def make_store(args):
     store = DataStore.new(args)
-    store.catch_up()
+    if args.no_load:
+        pass
+    elif args.bulk_load:
+        store.bulk_load()
+    else:
+        store.end_bulk_load()
+        store.catch_up()
     return store
 
+def catch_up_forever(store, interval):
+    """Load new blocks every interval seconds."""
+    log = logging.getLogger(__name__)
+    while True:
+        try:
+            store.wait_for_blocks(interval)
+            if store.catch_up():
+                store.save_catch_up_time(time.time())
+        except Exception:
+            log.exception("Failed to catch up")
+            try:
+                store.rollback()
+            except Exception:
+                log.exception("Rollback failed, reconnecting")
+                try:
+                    store.reconnect()
+                except Exception:
+                    log.exception("Reconnect failed")
+            # Do not spin while the failure lasts.
+            time.sleep(interval)
+
+def log_sql_stats(signum=None, frame=None):
+    """Log the SQL statistics of every database connection."""
+    log = logging.getLogger(__name__)
+    for line in sqlstats.report_all():
+        log.info("%s", line)
+
+def start_catch_up_thread(args, interval):
+    """Load new blocks periodically in a thread with its own
+    database connection."""
+    import threading
+    store = DataStore.new(args)
+    thread = threading.Thread(target=catch_up_forever,
+                              args=(store, interval),
+                              name="catch_up")
+    thread.daemon = True
+    thread.start()
+    return thread
+
 class NoSuchChainError(Exception):
     """Thrown when a chain lookup fails"""
 
@@ -155,6 +211,10 @@ class Abe:
         abe.address_history_rows_max = int(
             args.address_history_rows_max or 100000)
 
+        # Pages only read if blocks are loaded outside requests.
+        abe.catch_up_interval = float(args.catch_up_interval or 0)
+        abe.load_on_request = not (args.no_load or abe.catch_up_interval)
+
         if args.shortlink_type is None:
             abe.shortlink_type = ("firstbits" if store.use_firstbits else
                                   "non-firstbits")
@@ -172,6 +232,15 @@ class Abe:
             abe.shortlink_type = 10
 
     def __call__(abe, env, start_response):
+        # With connection-pool-size, each request has its own
+        # connection, and the rollback below ends only its transaction.
+        abe.store.checkout_connection()
+        try:
+            return abe.serve_page(env, start_response)
+        finally:
+            abe.store.checkin_connection()
+
+    def serve_page(abe, env, start_response):
         import urlparse
 
         status = '200 OK'
@@ -202,9 +271,12 @@ class Abe:
                 return abe.serve_static(cmd + env['PATH_INFO'], start_response)
 
             # Always be up-to-date, even if we means having to wait
-            # for a response!  XXX Could use threads, timers, or a
-            # cron job.
-            abe.store.catch_up()
+            # for a response!  Unless a thread, or another process,
+            # loads blocks: see catch-up-interval and no-load.
+            if abe.load_on_request:
+                abe.store.catch_up()
+            else:
+                page['data_age'] = abe.data_age()
 
             handler(page)
         except PageNotFound:
@@ -234,6 +306,7 @@ class Abe:
         tvars['title'] = flatten(page['title'])
         tvars['h1'] = flatten(page.get('h1') or page['title'])
         tvars['body'] = flatten(page['body'])
+        tvars['data_age'] = page.get('data_age', '')
         if abe.args.auto_agpl:
             tvars['download'] = (
                 ' <a href="' + page['dotdot'] + 'download">Source</a>')
@@ -243,6 +316,14 @@ class Abe:
             content = content.encode('UTF-8')
         return content
 
+    def data_age(abe):
+        """Return HTML showing how long ago blocks were last loaded."""
+        nTime = abe.store.get_catch_up_time()
+        if nTime is None:
+            return ''
+        return ('<p style="font-size: smaller">数据更新于 %d 秒前</p>'
+                % max(0, int(time.time()) - nTime))
+
     def get_handler(abe, cmd):
         return getattr(abe, 'handle_' + cmd, None)
 
@@ -380,15 +461,9 @@ class Abe:
         hi = get_int_param(page, 'hi')
         orig_hi = hi
 
+        top = abe.store.main_chain_height(chain['id'])
         if hi is None:
-            row = abe.store.selectrow("""
-                SELECT b.block_height
-                  FROM block b
-                  JOIN chain c ON (c.chain_last_block_id = b.block_id)
-                 WHERE c.chain_id = ?
-            """, (chain['id'],))
-            if row:
-                hi = row[0]
+            hi = top
         if hi is None:
             if orig_hi is None and count > 0:
                 body += ['<p>I have no blocks in this chain.</p>']
@@ -397,12 +472,19 @@ class Abe:
                          'The requested range contains no blocks.</p>\n']
             return
 
-        rows = abe.store.selectall("""
-            SELECT b.block_hash, b.block_height, (b.block_nTime+28800), b.block_num_tx,
+        columns = """b.block_hash, b.block_height, (b.block_nTime+28800), b.block_num_tx,
                    b.block_nBits, b.block_value_out,
                    b.block_total_seconds, b.block_satoshi_seconds,
                    b.block_total_satoshis, b.block_ss_destroyed,
-                   b.block_total_ss
+                   b.block_total_ss"""
+        rows = None
+        if top is not None:
+            rows = abe.store.select_main_chain_blocks(
+                chain['id'], columns,
+                xrange(min(hi, top), max(hi - count, -1), -1))
+        if rows is None:
+            rows = abe.store.selectall("""
+            SELECT """ + columns + """
               FROM block b
               JOIN chain_candidate cc ON (b.block_id = cc.block_id)
              WHERE cc.chain_id = ?
@@ -1671,6 +1753,52 @@ class Abe:
             return 'X5'
         return 'SZ'
 
+    def select_every_nth_block(abe, chain, interval, start, stop):
+        """
+        Return the height, time, chain work and nBits of every
+        INTERVAL longest-chain blocks from START to STOP.
+        """
+        columns = """b.block_height,
+                   (b.block_nTime+28800),
+                   b.block_chain_work,
+                   b.block_nBits"""
+
+        if stop is not None:
+            stop_ix = (stop - start) / interval
+
+        top = abe.store.main_chain_height(chain['id'])
+        if top is not None and interval > 0 and start >= 0:
+            last = top if stop is None else \
+                min(top, start + stop_ix * interval)
+            rows = abe.store.select_main_chain_blocks(
+                chain['id'], columns, xrange(start, last + 1, interval))
+            if rows is not None:
+                return rows
+
+        # Standard SQL lacks an "every Nth row" feature, so we
+        # provide it with the help of a table containing the integers.
+        # We don't need all integers, only as many as rows we want to
+        # fetch.  We happen to have a table with the desired integers,
+        # namely chain_candidate; its block_height column covers the
+        # required range without duplicates if properly constrained.
+        # That is the story of the second JOIN.
+        return abe.store.selectall("""
+            SELECT """ + columns + """
+              FROM block b
+              JOIN chain_candidate cc ON (cc.block_id = b.block_id)
+              JOIN chain_candidate ints ON (
+                       ints.chain_id = cc.chain_id
+                   AND ints.in_longest = 1
+                   AND ints.block_height * ? + ? = cc.block_height)
+             WHERE cc.in_longest = 1
+               AND cc.chain_id = ?""" + (
+                "" if stop is None else """
+               AND ints.block_height <= ?""") + """
+             ORDER BY cc.block_height""",
+                                   (interval, start, chain['id'])
+                                   if stop is None else
+                                   (interval, start, chain['id'], stop_ix))
+
     def q_hashrate(abe, page, chain):
         """显示最近 N 个区块的全网算力平均值(单位hashes/s，默认 N=1440[约为一天的数量])."""
         if chain is None:
@@ -1696,37 +1824,7 @@ class Abe:
                 interval = -interval
                 start = count - (count / interval) * interval
 
-        # Select every INTERVAL blocks from START to STOP.
-        # Standard SQL lacks an "every Nth row" feature, so we
-        # provide it with the help of a table containing the integers.
-        # We don't need all integers, only as many as rows we want to
-        # fetch.  We happen to have a table with the desired integers,
-        # namely chain_candidate; its block_height column covers the
-        # required range without duplicates if properly constrained.
-        # That is the story of the second JOIN.
-
-        if stop is not None:
-            stop_ix = (stop - start) / interval
-
-        rows = abe.store.selectall("""
-            SELECT b.block_height,
-                   (b.block_nTime+28800),
-                   b.block_chain_work,
-                   b.block_nBits
-              FROM block b
-              JOIN chain_candidate cc ON (cc.block_id = b.block_id)
-              JOIN chain_candidate ints ON (
-                       ints.chain_id = cc.chain_id
-                   AND ints.in_longest = 1
-                   AND ints.block_height * ? + ? = cc.block_height)
-             WHERE cc.in_longest = 1
-               AND cc.chain_id = ?""" + (
-                "" if stop is None else """
-               AND ints.block_height <= ?""") + """
-             ORDER BY cc.block_height""",
-                                   (interval, start, chain['id'])
-                                   if stop is None else
-                                   (interval, start, chain['id'], stop_ix))
+        rows = abe.select_every_nth_block(chain, interval, start, stop)
 
         for row in rows:
             height, nTime, chain_work, nBits = row
@@ -1784,37 +1882,7 @@ class Abe:
                 interval = -interval
                 start = count - (count / interval) * interval
 
-        # Select every INTERVAL blocks from START to STOP.
-        # Standard SQL lacks an "every Nth row" feature, so we
-        # provide it with the help of a table containing the integers.
-        # We don't need all integers, only as many as rows we want to
-        # fetch.  We happen to have a table with the desired integers,
-        # namely chain_candidate; its block_height column covers the
-        # required range without duplicates if properly constrained.
-        # That is the story of the second JOIN.
-
-        if stop is not None:
-            stop_ix = (stop - start) / interval
-
-        rows = abe.store.selectall("""
-            SELECT b.block_height,
-                   (b.block_nTime+28800),
-                   b.block_chain_work,
-                   b.block_nBits
-              FROM block b
-              JOIN chain_candidate cc ON (cc.block_id = b.block_id)
-              JOIN chain_candidate ints ON (
-                       ints.chain_id = cc.chain_id
-                   AND ints.in_longest = 1
-                   AND ints.block_height * ? + ? = cc.block_height)
-             WHERE cc.in_longest = 1
-               AND cc.chain_id = ?""" + (
-                "" if stop is None else """
-               AND ints.block_height <= ?""") + """
-             ORDER BY cc.block_height""",
-                                   (interval, start, chain['id'])
-                                   if stop is None else
-                                   (interval, start, chain['id'], stop_ix))
+        rows = abe.select_every_nth_block(chain, interval, start, stop)
         ret = NETHASH_HEADER
 
         for row in rows:
@@ -2131,6 +2199,11 @@ class Abe:
             tar.add(os.path.split(__file__)[0], name)
         raise Streamed()
 
+    def handle_sqlstats(abe, page):
+        if not abe.args.sql_stats_page:
+            raise PageNotFound()
+        abe.do_raw(page, "\n".join(sqlstats.report_all()) + "\n")
+
     def serve_static(abe, path, start_response):
         slen = len(abe.static_path)
         if path[:slen] != abe.static_path:
@@ -2292,15 +2365,166 @@ def redirect(page):
             '<body><h1>Moved</h1><p>This page has moved to '
             '<a href="' + uri + '">' + uri + '</a></body></html>')
 
+def serve_prefork(store):
+    """
+    Serve HTTP from worker processes, each with its own database
+    connection, sharing the block index through a file that this
+    process rewrites when a chain's tip changes.
+    """
+    import httpserver, signal, tempfile, shutil
+    args = store.args
+    log = logging.getLogger(__name__)
+    workers = int(args.workers or DEFAULT_WORKERS)
+    interval = float(args.catch_up_interval)
+    timeout = float(args.request_timeout or DEFAULT_REQUEST_TIMEOUT)
+    store.set_lock_pid(os.getpid())
+
+    tmpdir = tempfile.mkdtemp(prefix="abe-")
+    path = os.path.join(tmpdir, "block-index")
+    store.save_block_index(path)
+    tips = store.selectall("SELECT chain_id, chain_last_block_id FROM chain")
+
+    httpd = httpserver.WSGIServer(
+        (args.host, int(args.port or 80)), None, timeout,
+        float(args.keepalive_timeout or DEFAULT_KEEPALIVE_TIMEOUT))
+    # Workers that lose the race for a connection must not wait in
+    # accept.
+    httpd.socket.setblocking(0)
+
+    # Connections do not survive fork, so workers open their own.
+    store.disconnect()
+
+    def work():
+        signal.signal(signal.SIGTERM, httpd.stop)
+        signal.signal(signal.SIGINT, httpd.stop)
+        store = DataStore.new(args, block_index_file=path)
+        abe = Abe(store, args)
+        def app(env, start_response):
+            store.refresh_block_index()
+            return abe(env, start_response)
+        httpd.set_app(app)
+        httpd.serve_until_stopped()
+
+    children = set()
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                work()
+                status = 0
+            except:
+                log.exception("Worker %d failed", os.getpid())
+            finally:
+                os._exit(status)
+        children.add(pid)
+
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    # The open store, if any, to clear abe_lock at exit.
+    master = [None]
+
+    try:
+        for i in xrange(workers):
+            spawn()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        log.warning("Listening on http://%s:%d with %d processes",
+                    args.host, httpd.server_address[1], workers)
+
+        # Keep the block index loaded above.
+        store.reconnect()
+        master[0] = store
+        while not stopping:
+            store.wait_for_blocks(interval)
+            exited = 0
+            while children:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                children.discard(pid)
+                log.warning("Worker %d exited with status %d",
+                            pid, status)
+                exited += 1
+            if stopping:
+                break
+            if exited:
+                # Start the new workers without this connection.
+                store.disconnect()
+                for i in xrange(exited):
+                    spawn()
+                store.reconnect()
+            if not args.no_load and store.catch_up():
+                store.save_catch_up_time(time.time())
+            new_tips = store.selectall(
+                "SELECT chain_id, chain_last_block_id FROM chain")
+            if new_tips != tips:
+                store.save_block_index(path)
+                tips = new_tips
+            else:
+                store.rollback()
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        # Let workers finish their requests, but not forever.
+        deadline = time.time() + timeout
+        while children and time.time() < deadline:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.1)
+            else:
+                children.discard(pid)
+        for pid in children:
+            log.warning("Killing worker %d", pid)
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        httpd.server_close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if master[0] is not None:
+            master[0].rollback()
+            master[0].clear_lock_pid(os.getpid())
+
 def serve(store):
+    if store.args.server == "prefork":
+        return serve_prefork(store)
+    # Keep bulk load from running alongside.
+    store.set_lock_pid(os.getpid())
+    try:
+        _serve(store)
+    finally:
+        store.rollback()
+        store.clear_lock_pid(os.getpid())
+
+def _serve(store):
     args = store.args
     abe = Abe(store, args)
+    threaded = args.server == "threaded"
+    workers = int(args.workers or DEFAULT_WORKERS)
+    if abe.catch_up_interval and not args.no_load:
+        store.save_catch_up_time(time.time())
+        start_catch_up_thread(args, abe.catch_up_interval)
     if args.host or args.port:
         # HTTP server.
         if args.host is None:
             args.host = "localhost"
-        from wsgiref.simple_server import make_server
         port = int(args.port or 80)
+        if threaded:
+            import httpserver, signal
+            httpd = httpserver.ThreadedWSGIServer(
+                (args.host, port), abe, workers,
+                float(args.request_timeout or DEFAULT_REQUEST_TIMEOUT),
+                float(args.keepalive_timeout or DEFAULT_KEEPALIVE_TIMEOUT))
+            abe.log.warning("Listening on http://%s:%d with %d workers",
+                            args.host, port, workers)
+            signal.signal(signal.SIGTERM, httpd.stop)
+            signal.signal(signal.SIGINT, httpd.stop)
+            httpd.serve_until_stopped()
+            abe.log.warning("Stopped listening on http://%s:%d",
+                            args.host, port)
+            return
+        from wsgiref.simple_server import make_server
         httpd = make_server(args.host, port, abe)
         abe.log.warning("Listening on http://%s:%d", args.host, port)
         # httpd.shutdown() sometimes hangs, so don't call it.  XXX
@@ -2321,7 +2545,7 @@ def serve(store):
             from threading import Timer
             import signal
             def watch():
-                if not process_is_alive(wpid):
+                if not util.process_is_alive(wpid):
                     abe.log.warning("process %d terminated, exiting", wpid)
                     #os._exit(0)  # sys.exit merely raises an exception.
                     os.kill(os.getpid(), signal.SIGTERM)
@@ -2329,20 +2553,11 @@ def serve(store):
                 abe.log.log(0, "process %d found alive", wpid)
                 Timer(interval, watch).start()
             Timer(interval, watch).start()
-        WSGIServer(abe).run()
-
-def process_is_alive(pid):
-    # XXX probably fails spectacularly on Windows.
-    import errno
-    try:
-        os.kill(pid, 0)
-        return True
-    except OSError, e:
-        if e.errno == errno.EPERM:
-            return True  # process exists, but we can't send it signals.
-        if e.errno == errno.ESRCH:
-            return False # no such process.
-        raise
+        if threaded:
+            WSGIServer(abe, multithreaded=True, maxThreads=workers,
+                       maxSpare=workers).run()
+        else:
+            WSGIServer(abe).run()
 
 def main(argv):
     conf = {
@@ -2359,6 +2574,13 @@ def main(argv):
         "logging":                  None,
         "address_history_rows_max": None,
         "shortlink_type":           None,
+        "catch_up_interval":        None,
+        "no_load":                  None,
+        "sql_stats_page":           None,
+        "server":                   None,
+        "workers":                  None,
+        "request_timeout":          None,
+        "keepalive_timeout":        None,
 
         "template":     DEFAULT_TEMPLATE,
         "template_vars": {
@@ -2416,9 +2638,36 @@ See abe.conf for commented examples.""")
     if args.auto_agpl:
         import tarfile
 
-    store = make_store(args)
-    if (not args.no_serve):
-        serve(store)
+    import signal
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, log_sql_stats)
+
+    if args.server not in (None, "simple", "threaded", "prefork"):
+        raise ValueError("Unknown server: %s" % (args.server,))
+    if args.server == "prefork":
+        if not (args.host or args.port):
+            raise ValueError("server=prefork requires port or host")
+        if args.host is None:
+            args.host = "localhost"
+    if args.server in ("threaded", "prefork"):
+        # Workers only read.  A thread or process with its own store
+        # loads, so that none changes the block index under them.
+        args.catch_up_interval = (args.catch_up_interval or
+                                  DEFAULT_CATCH_UP_INTERVAL)
+    if args.server == "threaded" and args.connection_pool_size is None:
+        # Give each worker a connection.
+        args.connection_pool_size = int(args.workers or DEFAULT_WORKERS)
+
+    try:
+        store = make_store(args)
+        if (not args.no_serve):
+            serve(store)
+        elif args.catch_up_interval and not args.no_load:
+            # Run as a loader for servers configured with no-load.
+            store.save_catch_up_time(time.time())
+            catch_up_forever(store, float(args.catch_up_interval))
+    finally:
+        log_sql_stats()
     return 0
 
 if __name__ == '__main__':
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+# Copyright(C) 2012 by John Tobey <John.Tobey@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""Time loading a block file into a new SQLite database."""
+
+import os
+import sys
+import time
+import json
+import shutil
+import logging
+import tempfile
+import threading
+
+import DataStore
+import readconf
+import util
+import version
+
+# Stages of the load and the store methods they time.
+# Time in a stage excludes time in stages it calls.
+STAGES = [
+    ("read",          "_map_blkfile"),
+    ("parse_block",   "parse_block"),
+    ("scrypt",        None),  # util.scrypt
+    ("import_tx",     "import_tx"),
+    ("import_block",  "import_block"),
+    ("adopt_orphans", "adopt_orphans"),
+    ("commit",        "commit"),
+    ]
+
+class StageTimer(object):
+
+    def __init__(timer):
+        timer.seconds = dict((stage, 0.0) for stage, method in STAGES)
+        timer.calls = dict((stage, 0) for stage, method in STAGES)
+        timer._local = threading.local()
+
+    def wrap(timer, stage, func):
+        def timed(*args, **kwargs):
+            stack = timer._local.__dict__.setdefault('stack', [])
+            stack.append(0.0)  # Seconds spent in nested stages.
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                timer.seconds[stage] += elapsed - stack.pop()
+                timer.calls[stage] += 1
+                if stack:
+                    stack[-1] += elapsed
+        return timed
+
+def run(store, timer, bulk_load, profile=None):
+    """Load blocks with each stage timed.  Return the seconds taken."""
+    for stage, method in STAGES:
+        if method is not None:
+            setattr(store, method,
+                    timer.wrap(stage, getattr(store, method)))
+    scrypt = util.scrypt
+    util.scrypt = timer.wrap("scrypt", scrypt)
+    profiler = None
+    if profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.time()
+    try:
+        if bulk_load:
+            store.bulk_load()
+        else:
+            store.catch_up()
+        return time.time() - start
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        util.scrypt = scrypt
+
+def main(argv):
+    conf = {
+        "debug":                    None,
+        "logging":                  None,
+        "blkfile":                  None,
+        "dbfile":                   None,
+        "json":                     None,
+        "profile":                  None,
+        }
+    conf.update(DataStore.CONFIG_DEFAULTS)
+    command = list(argv)
+
+    args, argv = readconf.parse_argv(argv, conf,
+                                     strict=False)
+    if argv and argv[0] in ('-h', '--help'):
+        print ("""Usage: python -m Abe.benchmark [-h] [--config=FILE] [--CONFIGVAR=VALUE]...
+
+Load a block file into a new SQLite database through catch_up and
+report blocks, transactions and bytes per second and where the time
+went, as JSON.
+
+  --help                    Show this help message and exit.
+  --config FILE             Read options from FILE.
+  --blkfile FILE            Load blocks from FILE.
+  --dbfile FILE             Create the database in FILE, which must
+                            not exist.  By default, use a temporary
+                            file.
+  --json FILE               Write results to FILE instead of standard
+                            output.
+  --profile FILE            Write cProfile statistics of the load to
+                            FILE.
+
+Stage times exclude the stages they call.  scrypt counts only hashes
+computed in this process, not by --hash-workers.  Stages run by
+--pipeline-depth overlap the others, so the stages may add up to more
+than the total.
+
+All configuration variables may be given as command arguments.""")
+        return 0
+
+    if args.blkfile is None:
+        raise ValueError("--blkfile is required.")
+    if args.dbfile is not None and os.path.exists(args.dbfile):
+        raise ValueError("--dbfile %s exists." % (args.dbfile,))
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.DEBUG if args.debug else logging.WARNING,
+        format="%(message)s")
+    if args.logging is not None:
+        import logging.config as logging_config
+        logging_config.dictConfig(args.logging)
+
+    # catch_up reads blk-v1-0001.dat in each datadir.
+    tmpdir = tempfile.mkdtemp(prefix="abe-benchmark-")
+    try:
+        blkfile = os.path.abspath(args.blkfile)
+        os.symlink(blkfile, os.path.join(tmpdir, "blk-v1-0001.dat"))
+        args.datadir = [tmpdir]
+        args.dbtype = "sqlite3"
+        args.connect_args = args.dbfile or os.path.join(tmpdir, "abe.sqlite")
+        if args.int_type is None:
+            args.int_type = "str"
+
+        store = DataStore.new(args)
+        timer = StageTimer()
+        seconds = run(store, timer, args.bulk_load, args.profile)
+
+        nbytes = os.path.getsize(blkfile)
+        (blocks,) = store.selectrow("SELECT COUNT(*) FROM block")
+        (txs,) = store.selectrow("SELECT COUNT(*) FROM tx")
+        store.close()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    stages = dict(timer.seconds)
+    stages["other"] = seconds - sum(timer.seconds.values())
+    result = {
+        "version":              version.__version__,
+        "argv":                 command,
+        "blkfile":              blkfile,
+        "bytes":                nbytes,
+        "blocks":               int(blocks),
+        "txs":                  int(txs),
+        "seconds":              seconds,
+        "blocks_per_second":    int(blocks) / seconds,
+        "txs_per_second":       int(txs) / seconds,
+        "bytes_per_second":     nbytes / seconds,
+        "stages":               stages,
+        "calls":                timer.calls,
+        }
+    out = sys.stdout if args.json is None else open(args.json, "w")
+    json.dump(result, out, indent=2, sort_keys=True)
+    out.write("\n")
+    if out is not sys.stdout:
+        out.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
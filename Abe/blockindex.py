@@ -0,0 +1,362 @@
+# Copyright(C) 2011,2012 by John Tobey <John.Tobey@gmail.com>
+
+# blockindex.py: compact in-memory index of block heights and links.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""
+Hold the height, prev_block_id and search_block_id of every block
+with a height in three parallel arrays indexed by block_id.  This
+costs a few bytes per block where a dict of dicts costs hundreds.
+
+NONE marks a missing link, and a height of NONE marks a block_id not
+in the index.
+
+For each chain, a further array indexed by height holds the block_id
+of the chain's longest-chain block at that height, or NONE where not
+known.  Every block in such an array has the blocks below it as its
+ancestors, so ancestry checks against it need no walk.
+
+BlockIndex.save writes the arrays to a file of native words:
+MAGIC, count, the length of the block arrays, the number of chains,
+a chain_id and array length per chain, then the arrays themselves.
+MappedBlockIndex reads such a file through a shared read-only memory
+map.
+"""
+
+import os
+import sys
+import mmap
+import array
+import struct
+
+NONE = -1
+
+# Grow the arrays by at least this many entries at a time.
+GROW = 4096
+
+MAGIC = 0x31454241  # "ABE1"
+_WORD = struct.Struct('l')
+
+def _grow(arrays, size):
+    size = max(size - len(arrays[0]), GROW, len(arrays[0]) / 4)
+    filler = array.array('l', [NONE]) * size
+    for a in arrays:
+        a.extend(filler)
+
+class BlockIndex(object):
+
+    def __init__(index):
+        index.heights = array.array('l')
+        index.prev_ids = array.array('l')
+        index.search_ids = array.array('l')
+        index.count = 0
+        index.main = {}
+        index.loaded = False
+        index._pending = []
+        index._main_undo = []
+        index._loaded_pending = False
+
+    def _set(index, block_id, height, prev_id, search_id):
+        if block_id >= len(index.heights):
+            _grow((index.heights, index.prev_ids, index.search_ids),
+                  block_id + 1)
+        if index.heights[block_id] == NONE:
+            index.count += 1
+        index.heights[block_id] = height
+        index.prev_ids[block_id] = NONE if prev_id is None else prev_id
+        index.search_ids[block_id] = NONE if search_id is None else search_id
+
+    def put(index, block_id, height, prev_id, search_id):
+        index._set(block_id, height, prev_id, search_id)
+        index._pending.append(block_id)
+
+    def load(index, rows):
+        """
+        Add (block_id, height, prev_id, search_id) rows, marking the
+        index complete as of the current transaction.
+        """
+        put = index._set
+        for block_id, height, prev_id, search_id in rows:
+            put(int(block_id), int(height),
+                None if prev_id is None else int(prev_id),
+                None if search_id is None else int(search_id))
+        index.loaded = True
+        index._loaded_pending = True
+
+    def load_main(index, rows):
+        """Add (chain_id, height, block_id) longest-chain rows."""
+        set_main = index._set_main
+        for chain_id, height, block_id in rows:
+            set_main(int(chain_id), int(height), int(block_id))
+
+    def __contains__(index, block_id):
+        return (block_id < len(index.heights) and
+                index.heights[block_id] != NONE)
+
+    def height(index, block_id):
+        return index.heights[block_id]
+
+    def prev_id(index, block_id):
+        prev_id = index.prev_ids[block_id]
+        return None if prev_id == NONE else prev_id
+
+    def search_id(index, block_id):
+        search_id = index.search_ids[block_id]
+        return None if search_id == NONE else search_id
+
+    def _set_main(index, chain_id, height, block_id):
+        chain_id = int(chain_id)
+        ids = index.main.get(chain_id)
+        if ids is None:
+            ids = index.main[chain_id] = array.array('l')
+        if height >= len(ids):
+            _grow((ids,), height + 1)
+        old = ids[height]
+        ids[height] = NONE if block_id is None else block_id
+        return old
+
+    def set_main(index, chain_id, height, block_id, pending=True):
+        """
+        Record block_id, or None, as the chain's longest-chain block
+        at height.  If pending, forget it on rollback.
+        """
+        old = index._set_main(chain_id, height, block_id)
+        if pending:
+            index._main_undo.append((int(chain_id), height, old))
+
+    def truncate_main(index, chain_id, size):
+        """Forget the chain's longest-chain blocks from height size."""
+        ids = index.main.get(int(chain_id))
+        if ids is not None:
+            del ids[size:]
+
+    def main_block_id(index, chain_id, height):
+        ids = index.main.get(int(chain_id))
+        if ids is None or height < 0 or height >= len(ids) or \
+                ids[height] == NONE:
+            return None
+        return ids[height]
+
+    def main_ancestor(index, block_id, block_height, height):
+        """
+        If block_id at block_height is on a longest chain, return that
+        chain's block at height, else None.
+        """
+        for ids in index.main.itervalues():
+            if block_height < len(ids) and ids[block_height] == block_id:
+                if 0 <= height <= block_height and ids[height] != NONE:
+                    return ids[height]
+                return None
+        return None
+
+    def nbytes(index):
+        return sum(a.itemsize * len(a) for a in
+                   [index.heights, index.prev_ids, index.search_ids] +
+                   index.main.values())
+
+    def save(index, path):
+        """Write the index to path, replacing any file there at once."""
+        chains = sorted(index.main.items())
+        header = array.array('l', [MAGIC, index.count, len(index.heights),
+                                   len(chains)])
+        for chain_id, ids in chains:
+            header.extend([chain_id, len(ids)])
+        tmp = path + ".tmp"
+        file = open(tmp, "wb")
+        try:
+            for a in [header, index.heights, index.prev_ids,
+                      index.search_ids] + [ids for chain_id, ids in chains]:
+                a.tofile(file)
+        finally:
+            file.close()
+        os.rename(tmp, path)
+
+    def commit(index):
+        index._pending = []
+        index._main_undo = []
+        index._loaded_pending = False
+
+    def rollback(index):
+        """Forget blocks added since the last commit."""
+        if index._loaded_pending:
+            # The load may have seen rows that no longer exist.
+            index.__init__()
+            return
+        for block_id in index._pending:
+            if index.heights[block_id] != NONE:
+                index.heights[block_id] = NONE
+                index.prev_ids[block_id] = NONE
+                index.search_ids[block_id] = NONE
+                index.count -= 1
+        index._pending = []
+        while index._main_undo:
+            chain_id, height, old = index._main_undo.pop()
+            ids = index.main[chain_id]
+            if height < len(ids):
+                ids[height] = old
+
+class MappedBlockIndex(object):
+    """
+    Read a file written by BlockIndex.save without copying it, so that
+    processes mapping the same file share its memory.  Blocks and
+    longest-chain changes not in the file are kept in the process
+    until reopen() maps a newer file.
+    """
+
+    def __init__(index, path):
+        index.path = path
+        index._file = None
+        index._map = None
+        index.reopen()
+
+    def reopen(index):
+        file = open(index.path, "rb")
+        try:
+            st = os.fstat(file.fileno())
+            map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            file.close()
+            raise
+        magic, count, size, nchains = [
+            _WORD.unpack_from(map, i * _WORD.size)[0] for i in xrange(4)]
+        if magic != MAGIC:
+            map.close()
+            file.close()
+            raise ValueError("%s is not a block index file" % (index.path,))
+        index.close()
+        index._file = file
+        index._map = map
+        index._stat = (st.st_dev, st.st_ino, st.st_mtime)
+        index._count = count
+        index._size = size
+
+        offset = (4 + 2 * nchains) * _WORD.size
+        index._heights = offset
+        index._prev_ids = offset + size * _WORD.size
+        index._search_ids = offset + 2 * size * _WORD.size
+        offset += 3 * size * _WORD.size
+        index._main = {}
+        for i in xrange(nchains):
+            chain_id, length = [
+                _WORD.unpack_from(map, (4 + 2 * i + j) * _WORD.size)[0]
+                for j in (0, 1)]
+            index._main[chain_id] = (offset, length)
+            offset += length * _WORD.size
+
+        index._recent = BlockIndex()
+        index._recent.loaded = True
+        index._main_recent = {}  # chain_id -> {height: block_id or NONE}
+        index._main_size = {}    # chain_id -> heights kept from the file
+        index._main_undo = []
+        index.loaded = True
+
+    def changed(index):
+        """Return true if the file has been replaced since mapped."""
+        try:
+            st = os.stat(index.path)
+        except OSError:
+            return False
+        return (st.st_dev, st.st_ino, st.st_mtime) != index._stat
+
+    def close(index):
+        if index._map is not None:
+            index._map.close()
+            index._file.close()
+            index._map = None
+            index._file = None
+
+    def _word(index, offset, i):
+        return _WORD.unpack_from(index._map, offset + i * _WORD.size)[0]
+
+    @property
+    def count(index):
+        return index._count + index._recent.count
+
+    def __contains__(index, block_id):
+        return block_id in index._recent or (
+            block_id < index._size and
+            index._word(index._heights, block_id) != NONE)
+
+    def height(index, block_id):
+        if block_id in index._recent:
+            return index._recent.height(block_id)
+        return index._word(index._heights, block_id)
+
+    def prev_id(index, block_id):
+        if block_id in index._recent:
+            return index._recent.prev_id(block_id)
+        prev_id = index._word(index._prev_ids, block_id)
+        return None if prev_id == NONE else prev_id
+
+    def search_id(index, block_id):
+        if block_id in index._recent:
+            return index._recent.search_id(block_id)
+        search_id = index._word(index._search_ids, block_id)
+        return None if search_id == NONE else search_id
+
+    def put(index, block_id, height, prev_id, search_id):
+        index._recent.put(block_id, height, prev_id, search_id)
+
+    def _main_id(index, chain_id, height):
+        recent = index._main_recent.get(chain_id)
+        if recent is not None and height in recent:
+            return recent[height]
+        offset, length = index._main.get(chain_id, (0, 0))
+        length = min(length, index._main_size.get(chain_id, sys.maxint))
+        if height < 0 or height >= length:
+            return NONE
+        return index._word(offset, height)
+
+    def set_main(index, chain_id, height, block_id, pending=True):
+        chain_id = int(chain_id)
+        old = index._main_id(chain_id, height)
+        index._main_recent.setdefault(chain_id, {})[height] = (
+            NONE if block_id is None else block_id)
+        if pending:
+            index._main_undo.append((chain_id, height, old))
+
+    def truncate_main(index, chain_id, size):
+        chain_id = int(chain_id)
+        index._main_size[chain_id] = min(
+            size, index._main_size.get(chain_id, sys.maxint))
+        recent = index._main_recent.get(chain_id, {})
+        for height in [h for h in recent if h >= size]:
+            del recent[height]
+
+    def main_block_id(index, chain_id, height):
+        block_id = index._main_id(int(chain_id), height)
+        return None if block_id == NONE else block_id
+
+    def main_ancestor(index, block_id, block_height, height):
+        for chain_id in set(index._main) | set(index._main_recent):
+            if index._main_id(chain_id, block_height) == block_id:
+                if 0 <= height <= block_height:
+                    return index.main_block_id(chain_id, height)
+                return None
+        return None
+
+    def nbytes(index):
+        return len(index._map) + index._recent.nbytes()
+
+    def commit(index):
+        index._recent.commit()
+        index._main_undo = []
+
+    def rollback(index):
+        index._recent.rollback()
+        while index._main_undo:
+            chain_id, height, old = index._main_undo.pop()
+            index._main_recent[chain_id][height] = old
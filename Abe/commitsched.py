@@ -0,0 +1,66 @@
+# Copyright(C) 2011,2012 by John Tobey <John.Tobey@gmail.com>
+
+# commitsched.py: decide when the loader commits.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+import time
+
+class CommitScheduler(object):
+    """
+    Count the work done since the last commit and say when to commit:
+    as soon as any limit on bytes read, blocks, transactions or
+    milliseconds since the first uncommitted change is reached.  A
+    limit of None never triggers.
+    """
+
+    def __init__(sched, max_bytes=0, max_blocks=None, max_txs=None,
+                 max_ms=None):
+        sched.max_bytes = max_bytes
+        sched.max_blocks = max_blocks
+        sched.max_txs = max_txs
+        sched.max_ms = max_ms
+        sched.reset()
+
+    def reset(sched):
+        sched.nbytes = 0
+        sched.blocks = 0
+        sched.txs = 0
+        sched.rows = 0
+        sched.started = None
+
+    def add(sched, nbytes=0, blocks=0, txs=0, rows=0):
+        if sched.started is None:
+            sched.started = time.time()
+        sched.nbytes += nbytes
+        sched.blocks += blocks
+        sched.txs += txs
+        sched.rows += rows
+
+    def elapsed_ms(sched):
+        if sched.started is None:
+            return 0
+        return (time.time() - sched.started) * 1000
+
+    def due(sched):
+        if sched.started is None:
+            return False
+        return ((sched.max_bytes is not None and
+                 sched.nbytes >= sched.max_bytes) or
+                (sched.max_blocks is not None and
+                 sched.blocks >= sched.max_blocks) or
+                (sched.max_txs is not None and sched.txs >= sched.max_txs) or
+                (sched.max_ms is not None and
+                 sched.elapsed_ms() >= sched.max_ms))
@@ -0,0 +1,68 @@
+# Copyright(C) 2011,2012 by John Tobey <John.Tobey@gmail.com>
+
+# connpool.py: share a few database connections among threads.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+import threading
+
+class ConnectionPool(object):
+    """
+    Hand out up to max_size connections made by calling connect, one
+    thread at a time each.  get() waits while all are in use.
+    """
+
+    def __init__(pool, connect, max_size):
+        pool.connect = connect
+        pool.max_size = max_size
+        pool.size = 0
+        pool._idle = []
+        pool._cond = threading.Condition()
+
+    def get(pool):
+        with pool._cond:
+            while not pool._idle and pool.size >= pool.max_size:
+                pool._cond.wait()
+            if pool._idle:
+                return pool._idle.pop()
+            pool.size += 1
+        try:
+            return pool.connect()
+        except:
+            pool.discard(None)
+            raise
+
+    def put(pool, conn):
+        with pool._cond:
+            pool._idle.append(conn)
+            pool._cond.notify()
+
+    def discard(pool, conn):
+        """Forget a connection that get() returned, closing it."""
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        with pool._cond:
+            pool.size -= 1
+            pool._cond.notify()
+
+    def close(pool):
+        """Close the idle connections."""
+        with pool._cond:
+            idle, pool._idle = pool._idle, []
+        for conn in idle:
+            pool.discard(conn)
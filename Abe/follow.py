@@ -0,0 +1,137 @@
+# Copyright(C) 2011,2012 by John Tobey <John.Tobey@gmail.com>
+
+# follow.py: wait for block files to grow.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""
+Wait for changes to the block files in a set of directories, using
+Linux inotify where available and otherwise polling their sizes and
+modification times.
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+
+EVENT_HEADER = struct.Struct("iIII")
+
+def _is_blkfile(name):
+    return name.startswith("blk") and name.endswith(".dat")
+
+def _inotify_libc():
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+        return libc
+    except (ImportError, OSError, AttributeError):
+        return None
+
+class BlockFileWatcher(object):
+
+    def __init__(watcher, dirnames, poll_interval=1.0):
+        watcher.dirnames = list(dirnames)
+        watcher.poll_interval = poll_interval
+        watcher._fd = None
+        watcher._buf = ""
+
+        libc = _inotify_libc()
+        if libc is not None:
+            fd = libc.inotify_init()
+            mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+            for dirname in watcher.dirnames:
+                if fd >= 0 and libc.inotify_add_watch(fd, dirname, mask) < 0:
+                    os.close(fd)
+                    fd = -1
+            if fd >= 0:
+                watcher._fd = fd
+
+        watcher._state = watcher._stat()
+
+    def uses_inotify(watcher):
+        return watcher._fd is not None
+
+    def _stat(watcher):
+        state = []
+        for dirname in watcher.dirnames:
+            try:
+                names = sorted(os.listdir(dirname))
+            except OSError:
+                continue
+            for name in filter(_is_blkfile, names):
+                try:
+                    st = os.stat(os.path.join(dirname, name))
+                except OSError:
+                    continue
+                state.append((dirname, name, st.st_size, st.st_mtime))
+        return state
+
+    def wait(watcher, timeout):
+        """
+        Return True as soon as a block file may have changed, or
+        False after timeout seconds without a change.
+        """
+        deadline = time.time() + timeout
+        while True:
+            left = deadline - time.time()
+            if left <= 0:
+                return False
+            if watcher._fd is None:
+                time.sleep(min(left, watcher.poll_interval))
+                state = watcher._stat()
+                if state != watcher._state:
+                    watcher._state = state
+                    return True
+                continue
+            try:
+                ready, _, _ = select.select([watcher._fd], [], [], left)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if ready and watcher._read_events():
+                return True
+
+    def _read_events(watcher):
+        """Consume pending events; return True if any named a block
+        file."""
+        watcher._buf += os.read(watcher._fd, 65536)
+        found = False
+        while len(watcher._buf) >= EVENT_HEADER.size:
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(watcher._buf)
+            end = EVENT_HEADER.size + length
+            if len(watcher._buf) < end:
+                break
+            name = watcher._buf[EVENT_HEADER.size : end].rstrip("\0")
+            watcher._buf = watcher._buf[end:]
+            if _is_blkfile(name):
+                found = True
+        return found
+
+    def close(watcher):
+        if watcher._fd is not None:
+            os.close(watcher._fd)
+            watcher._fd = None
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+# Copyright(C) 2012 by John Tobey <John.Tobey@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""Write a synthetic block file for repeatable load benchmarks."""
+
+import sys
+import random
+import logging
+
+import DataStore
+import readconf
+import BCDataStream, util
+
+# The scrypt N-factor grows with nTime, so early times hash fastest.
+START_TIME = 1372000000
+SPACING = 60
+NBITS = 0x1e0fffff
+REWARD = 100 * 10**6
+
+def _tx(nTime, txins, txouts):
+    ds = BCDataStream.BCDataStream()
+    ds.write_int32(1)
+    ds.write_uint32(nTime)
+    ds.write_compact_size(len(txins))
+    for prevout_hash, prevout_n, scriptSig in txins:
+        ds.write(prevout_hash)
+        ds.write_uint32(prevout_n)
+        ds.write_compact_size(len(scriptSig))
+        ds.write(scriptSig)
+        ds.write_uint32(0xffffffff)
+    ds.write_compact_size(len(txouts))
+    for value, scriptPubKey in txouts:
+        ds.write_int64(value)
+        ds.write_compact_size(len(scriptPubKey))
+        ds.write(scriptPubKey)
+    ds.write_uint32(0)  # lockTime
+    return ds.input
+
+class ChainGenerator(object):
+    """
+    Build blocks whose transactions spend random earlier outputs.
+    Everything random comes from one seeded generator, so equal
+    arguments give an identical file.
+    """
+
+    def __init__(gen, magic, seed=1, txs_per_block=10, inputs=1, outputs=2,
+                 address_reuse=0.5, start_time=START_TIME):
+        gen.magic = magic
+        gen.rnd = random.Random(seed)
+        gen.txs_per_block = txs_per_block
+        gen.inputs = inputs
+        gen.outputs = outputs
+        gen.address_reuse = address_reuse
+        gen.start_time = start_time
+        gen.addresses = []
+        gen.unspent = []  # (tx_hash, output_n, value)
+        gen.tx_count = 0
+
+    def _script(gen):
+        if gen.addresses and gen.rnd.random() < gen.address_reuse:
+            pubkey_hash = gen.rnd.choice(gen.addresses)
+        else:
+            pubkey_hash = ("%040x" % gen.rnd.getrandbits(160)).decode('hex')
+            gen.addresses.append(pubkey_hash)
+        # OP_DUP OP_HASH160 <pubkey_hash> OP_EQUALVERIFY OP_CHECKSIG
+        return "\x76\xa9\x14" + pubkey_hash + "\x88\xac"
+
+    def _spend(gen):
+        """Remove and return a random unspent output."""
+        unspent = gen.unspent
+        i = gen.rnd.randrange(len(unspent))
+        unspent[i], unspent[-1] = unspent[-1], unspent[i]
+        return unspent.pop()
+
+    def block(gen, hashPrev, height, tag="", spend=True):
+        """
+        Return a block file record and the block's hash.  A block
+        with spend false holds only a coinbase whose output is never
+        spent, for use on a side chain.
+        """
+        nTime = gen.start_time + height * SPACING + len(tag)
+        coinbase = _tx(nTime, [(DataStore.NULL_HASH, 0xffffffff,
+                                "%d/%s" % (height, tag))],
+                       [(REWARD, gen._script())])
+        txs = [coinbase]
+        created = []
+        if spend:
+            created.append((util.double_sha256(coinbase), 0, REWARD))
+            for i in xrange(gen.txs_per_block - 1):
+                if not gen.unspent:
+                    break
+                spent = [gen._spend() for j in
+                         xrange(min(gen.inputs, len(gen.unspent)))]
+                value = sum(v for h, n, v in spent)
+                values = [value / gen.outputs] * gen.outputs
+                values[-1] += value - sum(values)
+                tx = _tx(nTime, [(h, n, "\x00") for h, n, v in spent],
+                         [(v, gen._script()) for v in values])
+                tx_hash = util.double_sha256(tx)
+                txs.append(tx)
+                created += [(tx_hash, n, values[n])
+                            for n in xrange(len(values))]
+        gen.tx_count += len(txs)
+
+        header = BCDataStream.BCDataStream()
+        header.write_int32(1)
+        header.write(hashPrev)
+        header.write(util.merkle(map(util.double_sha256, txs)))
+        header.write_uint32(nTime)
+        header.write_uint32(NBITS)
+        header.write_uint32(height)  # nNonce
+        body = BCDataStream.BCDataStream()
+        body.write(header.input)
+        body.write_compact_size(len(txs))
+        body.write("".join(txs))
+        body.write_compact_size(0)  # blockSig
+        record = BCDataStream.BCDataStream()
+        record.write(gen.magic)
+        record.write_uint32(len(body.input))
+        record.write(body.input)
+
+        # Outputs become spendable once the block is on the main chain.
+        gen.unspent += created
+        return record.input, util.scrypt(header.input)
+
+    def generate(gen, count, fork_every=0, fork_length=2, orphan_every=0):
+        """
+        Return block file records of count main chain blocks.
+
+        Every fork_every blocks, a side chain of fork_length blocks
+        grows from the tip before the next main chain block, so the
+        loader switches to it and back again.  Every orphan_every
+        blocks, a block comes just before its parent.
+        """
+        records = []
+        hashPrev = DataStore.GENESIS_HASH_PREV
+        parent_pos = None
+        for height in xrange(count):
+            if fork_every and height > 1 and height % fork_every == 0:
+                fork_hash = hashPrev
+                for i in xrange(fork_length):
+                    record, fork_hash = gen.block(
+                        fork_hash, height + i, "fork", spend=False)
+                    records.append(record)
+            record, hashPrev = gen.block(hashPrev, height)
+            if orphan_every and height > 0 and height % orphan_every == 0:
+                records.insert(parent_pos, record)
+            else:
+                parent_pos = len(records)
+                records.append(record)
+        return records
+
+def main(argv):
+    conf = {
+        "debug":                    None,
+        "logging":                  None,
+        "blkfile":                  None,
+        "chain":                    "Ybcoin",
+        "count":                    1000,
+        "txs_per_block":            10,
+        "inputs":                   1,
+        "outputs":                  2,
+        "address_reuse":            0.5,
+        "fork_every":               0,
+        "fork_length":              2,
+        "orphan_every":             0,
+        "seed":                     1,
+        "start_time":               START_TIME,
+        }
+
+    args, argv = readconf.parse_argv(argv, conf,
+                                     strict=False)
+    if argv and argv[0] in ('-h', '--help'):
+        print ("""Usage: python -m Abe.genchain [-h] [--config=FILE] [--CONFIGVAR=VALUE]...
+
+Write a synthetic block file for load benchmarks.  Name it
+blk-v1-0001.dat in an empty directory and load that directory with
+--datadir.
+
+  --help                    Show this help message and exit.
+  --config FILE             Read options from FILE.
+  --blkfile FILE            Write blocks to FILE.
+  --chain NAME              Use the magic number of chain NAME
+                            (default Ybcoin).
+  --count NUMBER            Write NUMBER main chain blocks.
+  --txs-per-block NUMBER    Transactions per block, counting the
+                            coinbase.
+  --inputs NUMBER           Inputs per non-coinbase transaction.
+  --outputs NUMBER          Outputs per non-coinbase transaction.
+  --address-reuse FRACTION  Chance that an output pays an address
+                            already used.
+  --fork-every NUMBER       Grow a side chain every NUMBER blocks.
+  --fork-length NUMBER      Blocks per side chain (default 2).
+  --orphan-every NUMBER     Write every NUMBERth block before its
+                            parent.
+  --seed NUMBER             Random seed.  Equal options and seed give
+                            an identical file.
+  --start-time SECONDS      nTime of the first block.  The default is
+                            early, where proof-of-work hashing is
+                            fastest.""")
+        return 0
+
+    if args.blkfile is None:
+        raise ValueError("--blkfile is required.")
+
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.DEBUG,
+        format="%(message)s")
+    if args.logging is not None:
+        import logging.config as logging_config
+        logging_config.dictConfig(args.logging)
+
+    magic = None
+    for chain in DataStore.CHAIN_CONFIG:
+        if chain["chain"] == args.chain:
+            magic = chain["magic"]
+    if magic is None:
+        raise ValueError("Unknown chain: %s" % (args.chain,))
+
+    gen = ChainGenerator(
+        magic, int(args.seed), int(args.txs_per_block), int(args.inputs),
+        int(args.outputs), float(args.address_reuse), int(args.start_time))
+    records = gen.generate(
+        int(args.count), int(args.fork_every), int(args.fork_length),
+        int(args.orphan_every))
+    file = open(args.blkfile, "wb")
+    for record in records:
+        file.write(record)
+    file.close()
+    logging.info("Wrote %d blocks, %d transactions, %d addresses to %s",
+                 len(records), gen.tx_count, len(gen.addresses),
+                 args.blkfile)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
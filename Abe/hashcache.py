@@ -0,0 +1,113 @@
+# Copyright(C) 2011,2012 by John Tobey <John.Tobey@gmail.com>
+
+# hashcache.py: sidecar file of block header proof-of-work hashes.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""
+Remember the scrypt hashes of the headers in a block file so that
+loading the file into a new database need not compute them again.
+
+The sidecar file is a sequence of fixed-size records:
+
+    offset   8 bytes, little-endian offset of the header in the block file
+    header  80 bytes, the header as hashed
+    hash    32 bytes, its proof-of-work hash
+    check    4 bytes, start of the SHA-256 of the preceding 120 bytes
+
+Records are only ever appended.  A record cut short by a crash or
+failing its check ends the usable part of the file, and the next
+append overwrites it.  Where records disagree about an offset, the
+last one wins.
+"""
+
+import os
+import errno
+import struct
+import hashlib
+
+SUFFIX = ".powhash"
+
+RECORD = struct.Struct("<Q80s32s4s")
+
+def _check(data):
+    return hashlib.sha256(data).digest()[:4]
+
+class HeaderHashCache(object):
+
+    def __init__(cache, filename):
+        cache.filename = filename
+        cache._hashes = {}
+        cache._fd = None
+        cache._valid_size = 0
+        cache._torn = False
+        cache._load()
+        cache._open_for_append()
+
+    def _load(cache):
+        try:
+            f = open(cache.filename, "rb")
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        end = 0
+        while end + RECORD.size <= len(data):
+            offset, header, hash, check = RECORD.unpack_from(data, end)
+            if check != _check(data[end : end + RECORD.size - 4]):
+                break
+            cache._hashes[offset] = (header, hash)
+            end += RECORD.size
+        cache._valid_size = end
+        cache._torn = end < len(data)
+
+    def get(cache, offset, header):
+        """
+        Return the hash recorded for header at offset, or None if
+        there is none or the recorded header differs.
+        """
+        entry = cache._hashes.get(offset)
+        if entry is None or entry[0] != header:
+            return None
+        return entry[1]
+
+    def put(cache, offset, header, hash):
+        if cache._hashes.get(offset) == (header, hash):
+            return
+        data = RECORD.pack(offset, header, hash, "")[:-4]
+        os.write(cache._fd, data + _check(data))
+        cache._hashes[offset] = (header, hash)
+
+    def _open_for_append(cache):
+        fd = os.open(cache.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0666)
+        try:
+            # Drop any torn or corrupt tail before appending.
+            if cache._torn:
+                os.ftruncate(fd, cache._valid_size)
+        except:
+            os.close(fd)
+            raise
+        cache._fd = fd
+
+    def close(cache):
+        if cache._fd is not None:
+            os.close(cache._fd)
+            cache._fd = None
@@ -0,0 +1,238 @@
+# Copyright(C) 2011,2012 by John Tobey <John.Tobey@gmail.com>
+
+# httpserver.py: threaded HTTP/1.1 server for the WSGI application.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""
+Serve a WSGI application over HTTP/1.1.  WSGIServer serves one
+connection at a time, so several processes may share its socket.
+ThreadedWSGIServer serves from a fixed number of worker threads.  Its
+listening thread queues each new connection for the next free worker,
+and stops accepting while all are busy.  Either keeps serving a
+connection until the client closes it, a response has no known length,
+timeout seconds pass without a complete request, or keepalive_timeout
+seconds pass before the next request begins.  ThreadedWSGIServer also
+closes an idle connection when a new one waits for a busy worker.
+
+stop() makes serve_until_stopped() close the listening socket and
+return after in-flight requests finish, waiting at most timeout
+seconds.
+"""
+
+import time
+import Queue
+import select
+import socket
+import threading
+from wsgiref import simple_server
+
+class _ServerHandler(simple_server.ServerHandler):
+
+    def cleanup_headers(handler):
+        simple_server.ServerHandler.cleanup_headers(handler)
+        request = handler.request_handler
+        if request.close_connection or request.server.stopping or \
+                'Content-Length' not in handler.headers:
+            request.close_connection = 1
+            if handler.http_version == "1.1":
+                handler.headers['Connection'] = 'close'
+        elif handler.http_version == "1.0":
+            handler.headers['Connection'] = 'keep-alive'
+
+class _RequestHandler(simple_server.WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle(request):
+        """Handle HTTP requests until the connection should close."""
+        request.close_connection = 1
+        try:
+            if request._handle_one():
+                while request._handle_next():
+                    pass
+        except (socket.timeout, socket.error):
+            pass
+
+    def _handle_next(request):
+        """Wait a short while for another request, then handle it."""
+        server = request.server
+        request.connection.settimeout(server.keepalive_timeout)
+        server._idle_connection(request.connection, True)
+        try:
+            request.raw_requestline = request.rfile.readline(65537)
+        finally:
+            server._idle_connection(request.connection, False)
+        request.connection.settimeout(server.request_timeout)
+        return request._handle_one(False)
+
+    def _handle_one(request, read=True):
+        if read:
+            request.raw_requestline = request.rfile.readline(65537)
+        if not request.raw_requestline:
+            return False
+        if len(request.raw_requestline) > 65536:
+            request.requestline = ''
+            request.request_version = ''
+            request.command = ''
+            request.send_error(414)
+            return False
+        if not request.parse_request():
+            return False
+
+        # We do not read request bodies the application leaves, and
+        # the handler sends a body even for HEAD.
+        if request.headers.get('Content-Length', '0') != '0' or \
+                'Transfer-Encoding' in request.headers or \
+                request.command == 'HEAD':
+            request.close_connection = 1
+
+        handler = _ServerHandler(
+            request.rfile, request.wfile, request.get_stderr(),
+            request.get_environ())
+        handler.request_handler = request
+        if request.request_version == "HTTP/1.1":
+            handler.http_version = "1.1"
+        handler.run(request.server.get_app())
+        request.wfile.flush()
+        return not request.close_connection
+
+def _listify(app):
+    """
+    Wrap app so that a str result goes out in one write with a
+    Content-Length, not one byte at a time without one.
+    """
+    def wrapped(environ, start_response):
+        result = app(environ, start_response)
+        if isinstance(result, str):
+            result = [result]
+        return result
+    return wrapped
+
+class WSGIServer(simple_server.WSGIServer):
+
+    def __init__(server, address, app, timeout, keepalive_timeout=None):
+        simple_server.WSGIServer.__init__(server, address, _RequestHandler)
+        server.set_app(app)
+        server.request_timeout = timeout
+        server.keepalive_timeout = (timeout if keepalive_timeout is None
+                                    else keepalive_timeout)
+        server.stopping = False
+
+    def set_app(server, app):
+        simple_server.WSGIServer.set_app(server, _listify(app))
+
+    def process_request(server, conn, client_address):
+        conn.settimeout(server.request_timeout)
+        simple_server.WSGIServer.process_request(
+            server, conn, client_address)
+
+    def stop(server, signum=None, frame=None):
+        server.stopping = True
+
+    def _idle_connection(server, conn, idle):
+        """Note whether conn is waiting for its next request."""
+        pass
+
+    def _ready(server, timeout):
+        """Return true if a new connection can be served now."""
+        return True
+
+    def serve_until_stopped(server, poll_interval=0.5):
+        server.timeout = poll_interval
+        while not server.stopping:
+            if server._ready(poll_interval):
+                server.handle_request()
+        server.server_close()
+
+class ThreadedWSGIServer(WSGIServer):
+
+    def __init__(server, address, app, workers, timeout,
+                 keepalive_timeout=None):
+        WSGIServer.__init__(server, address, app, timeout, keepalive_timeout)
+        # Connections pass through the queue only to idle workers.
+        server._queue = Queue.Queue()
+        server._idle = workers
+        server._idle_cond = threading.Condition()
+        server._waiting = []  # Connections between requests, oldest first.
+        server._workers = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=server._work,
+                                      name="HTTP worker %d" % (i,))
+            thread.daemon = True
+            thread.start()
+            server._workers.append(thread)
+
+    def _idle_connection(server, conn, idle):
+        with server._idle_cond:
+            if idle:
+                server._waiting.append(conn)
+            elif conn in server._waiting:
+                server._waiting.remove(conn)
+
+    def _ready(server, timeout):
+        deadline = time.time() + timeout
+        with server._idle_cond:
+            while server._idle == 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                if server._waiting and \
+                        select.select([server.socket], [], [], 0)[0]:
+                    # A new client waits.  End the read of the longest
+                    # idle connection so that its worker comes free.
+                    try:
+                        server._waiting.pop(0).shutdown(socket.SHUT_RD)
+                    except socket.error:
+                        pass
+                    server._idle_cond.wait(remaining)
+                else:
+                    server._idle_cond.wait(min(remaining, 0.05))
+            return True
+
+    def process_request(server, conn, client_address):
+        conn.settimeout(server.request_timeout)
+        with server._idle_cond:
+            server._idle -= 1
+        server._queue.put((conn, client_address))
+
+    def _work(server):
+        while True:
+            item = server._queue.get()
+            if item is None:
+                return
+            conn, client_address = item
+            try:
+                server.finish_request(conn, client_address)
+            except Exception:
+                server.handle_error(conn, client_address)
+            server.shutdown_request(conn)
+            with server._idle_cond:
+                server._idle += 1
+                server._idle_cond.notify()
+
+    def serve_until_stopped(server, poll_interval=0.5):
+        WSGIServer.serve_until_stopped(server, poll_interval)
+        # Close connections no worker has started on.
+        while True:
+            try:
+                conn, client_address = server._queue.get_nowait()
+            except Queue.Empty:
+                break
+            server.shutdown_request(conn)
+        for thread in server._workers:
+            server._queue.put(None)
+        deadline = time.time() + server.request_timeout
+        for thread in server._workers:
+            thread.join(max(0, deadline - time.time()))
@@ -0,0 +1,64 @@
+# Copyright(C) 2011,2012 by John Tobey <John.Tobey@gmail.com>
+
+# lru.py: bounded caches of database lookups.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+import collections
+
+class LRUCache(object):
+    """
+    Map holding at most max_size entries, discarding the least
+    recently used.  Entries put since the last commit() may describe
+    rows that a rollback removes, so rollback() forgets them.
+    """
+
+    def __init__(cache, max_size):
+        cache.max_size = max_size
+        cache.hits = 0
+        cache.misses = 0
+        cache._map = collections.OrderedDict()
+        cache._pending = set()
+
+    def __len__(cache):
+        return len(cache._map)
+
+    def get(cache, key, default=None):
+        try:
+            value = cache._map.pop(key)
+        except KeyError:
+            cache.misses += 1
+            return default
+        cache._map[key] = value
+        cache.hits += 1
+        return value
+
+    def put(cache, key, value):
+        if cache.max_size <= 0:
+            return
+        cache._map.pop(key, None)
+        cache._map[key] = value
+        cache._pending.add(key)
+        while len(cache._map) > cache.max_size:
+            old_key, old_value = cache._map.popitem(last=False)
+            cache._pending.discard(old_key)
+
+    def commit(cache):
+        cache._pending.clear()
+
+    def rollback(cache):
+        for key in cache._pending:
+            cache._map.pop(key, None)
+        cache._pending.clear()
@@ -19,6 +19,7 @@
 """Load blocks in different order for testing."""
 
 import sys
+import time
 import logging
 
 import DataStore
@@ -49,7 +50,10 @@ def mixup_blocks(store, ds, count, datadir_chain_id = None, seed = None):
     elif seed:
         offsets = offsets[::-1]  # XXX want random
 
-    for offset in offsets:
+    hashes = store.hash_headers(
+        [ds.input[offset + 8 : offset + 88] for offset in offsets])
+
+    for offset, hash in zip(offsets, hashes):
         ds.read_cursor = offset
         magic = ds.read_bytes(4)
         length = ds.read_int32()
@@ -75,8 +79,6 @@ def mixup_blocks(store, ds, count, datadir_chain_id = None, seed = None):
         # XXX pasted out of DataStore.import_blkdat
         end = ds.read_cursor + length
 
-        hash = util.scrypt(
-            ds.input[ds.read_cursor : ds.read_cursor + 80])
         # XXX should decode target and check hash against it to
         # avoid loading garbage data.  But not for merged-mined or
         # CPU-mined chains that use different proof-of-work
@@ -127,14 +129,40 @@ def mixup_blocks(store, ds, count, datadir_chain_id = None, seed = None):
                                 end - ds.read_cursor)
 
         bytes_done += length
-        if bytes_done >= store.commit_bytes:
-            store.log.debug("commit")
+        store.commit_sched.add(nbytes=length)
+        if store.commit_sched.due():
             store.commit()
             bytes_done = 0
 
     if bytes_done > 0:
         store.commit()
 
+def reorg_benchmark(store, depths):
+    """
+    Time reorganizations of each depth by moving each chain's longest
+    chain back from its last block to an ancestor and forward again.
+    Roll back afterwards, leaving the database unchanged.
+    """
+    for (chain_id,) in store.selectall("SELECT chain_id FROM chain"):
+        chain_id = int(chain_id)
+        top = store.main_chain_height(chain_id)
+        if top is None:
+            continue
+        tip_id = store.main_chain_block_id(chain_id, top)
+        for depth in depths:
+            if depth > top:
+                break
+            fork_id = store.main_chain_block_id(chain_id, top - depth)
+            t0 = time.time()
+            store.reorganize(chain_id, tip_id, top, fork_id, top - depth)
+            t1 = time.time()
+            store.reorganize(chain_id, fork_id, top - depth, tip_id, top)
+            t2 = time.time()
+            store.log.info("chain %d reorg depth %d: %.3f ms back,"
+                           " %.3f ms forward", chain_id, depth,
+                           (t1 - t0) * 1000, (t2 - t1) * 1000)
+        store.rollback()
+
 def main(argv):
     conf = {
         "debug":                    None,
@@ -142,6 +170,7 @@ def main(argv):
         "count":                    200,
         "seed":                     1,
         "blkfile":                  None,
+        "reorg_depths":             None,
         }
     conf.update(DataStore.CONFIG_DEFAULTS)
 
@@ -157,6 +186,8 @@ Load blocks out of order.
   --count NUMBER            Load COUNT blocks.
   --blkfile FILE            Load the first COUNT blocks from FILE.
   --seed NUMBER             Random seed (not implemented; 0=file order).
+  --reorg-depths N,N,...    After loading, time reorganizations of
+                            these depths, then undo them.
 
 All configuration variables may be given as command arguments.""")
         return 0
@@ -178,6 +209,11 @@ All configuration variables may be given as command arguments.""")
     ds.map_file(file, 0)
     file.close()
     mixup_blocks(store, ds, int(args.count), None, int(args.seed or 0))
+    if args.reorg_depths is not None:
+        depths = args.reorg_depths
+        if isinstance(depths, basestring):
+            depths = depths.split(",")
+        reorg_benchmark(store, sorted(map(int, depths)))
     return 0
 
 if __name__ == '__main__':
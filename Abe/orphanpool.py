@@ -0,0 +1,70 @@
+# Copyright(C) 2011,2012 by John Tobey <John.Tobey@gmail.com>
+
+# orphanpool.py: hold blocks that arrive before their parents.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+import collections
+
+class OrphanPool(object):
+    """
+    Parsed blocks waiting for their parents, up to max_bytes of block
+    data.  Blocks come out oldest first, either as children of a
+    newly imported block or to make room.
+    """
+
+    def __init__(pool, max_bytes):
+        pool.max_bytes = max_bytes
+        pool.nbytes = 0
+        pool.last_imported = None  # Hash of the last block imported.
+        pool._blocks = collections.OrderedDict()  # hash -> entry
+        pool._children = {}  # hashPrev -> [hash, ...]
+
+    def __len__(pool):
+        return len(pool._blocks)
+
+    def __contains__(pool, hash):
+        return hash in pool._blocks
+
+    def add(pool, hash, hashPrev, size, item):
+        pool._blocks[hash] = (hashPrev, size, item)
+        pool._children.setdefault(hashPrev, []).append(hash)
+        pool.nbytes += size
+
+    def full(pool):
+        return pool.nbytes > pool.max_bytes
+
+    def oldest(pool):
+        """Return the item added earliest, or None if empty."""
+        for hashPrev, size, item in pool._blocks.itervalues():
+            return item
+        return None
+
+    def _remove(pool, hash):
+        hashPrev, size, item = pool._blocks.pop(hash)
+        pool.nbytes -= size
+        siblings = pool._children[hashPrev]
+        siblings.remove(hash)
+        if not siblings:
+            del pool._children[hashPrev]
+        return item
+
+    def pop_oldest(pool):
+        return pool._remove(next(iter(pool._blocks)))
+
+    def pop_children(pool, hash):
+        """Remove and return the items whose parent is hash."""
+        return [pool._remove(child)
+                for child in list(pool._children.get(hash, ()))]
@@ -0,0 +1,117 @@
+# Copyright(C) 2011,2012 by John Tobey <John.Tobey@gmail.com>
+
+# sqlstats.py: count and time SQL statements.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""
+Keep, per statement, the number of calls, total and maximum seconds,
+rows fetched, and a histogram of latencies in power-of-two buckets of
+microseconds, from which percentiles are estimated to within a factor
+of two.  Statements are keyed by their text as passed to DataStore,
+before any transformation.
+"""
+
+import time
+import weakref
+
+# Bucket i counts calls taking under 2**i microseconds.
+BUCKETS = 32
+
+# Every live collector, for report_all().
+_collectors = []
+
+class SqlStats(object):
+
+    def __init__(stats):
+        stats.reset()
+        _collectors[:] = [ref for ref in _collectors if ref() is not None]
+        _collectors.append(weakref.ref(stats))
+
+    def reset(stats):
+        stats.started = time.time()
+        stats._entries = {}  # stmt -> [calls, seconds, max, rows, buckets]
+
+    def record(stats, stmt, seconds, rows=0):
+        entry = stats._entries.get(stmt)
+        if entry is None:
+            entry = stats._entries[stmt] = [0, 0.0, 0.0, 0, [0] * BUCKETS]
+        entry[0] += 1
+        entry[1] += seconds
+        if seconds > entry[2]:
+            entry[2] = seconds
+        entry[3] += rows
+        entry[4][min(int(seconds * 1000000).bit_length(), BUCKETS - 1)] += 1
+
+    def rows(stats):
+        """
+        Return a dict per statement with keys stmt, calls, seconds,
+        max, rows, p50, p90 and p99, slowest in total first.
+        """
+        ret = []
+        for stmt, (calls, seconds, max_seconds, rows, buckets) in \
+                stats._entries.items():
+            ret.append({
+                    "stmt":    " ".join(stmt.split()),
+                    "calls":   calls,
+                    "seconds": seconds,
+                    "max":     max_seconds,
+                    "rows":    rows,
+                    "p50":     _percentile(buckets, max_seconds, 0.50),
+                    "p90":     _percentile(buckets, max_seconds, 0.90),
+                    "p99":     _percentile(buckets, max_seconds, 0.99),
+                    })
+        ret.sort(key=lambda row: -row["seconds"])
+        return ret
+
+    def report(stats, limit=None):
+        """Return the statistics as lines of text."""
+        rows = stats.rows()
+        lines = ["%d statements in %.0f seconds" % (
+                len(rows), time.time() - stats.started),
+                 "%8s %10s %8s %8s %8s %8s %10s %10s  %s" % (
+                "calls", "total_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms",
+                "rows", "rows/call", "statement")]
+        for row in rows[:limit]:
+            lines.append("%8d %10.1f %8.3f %8.3f %8.3f %8.3f %10d %10.1f  %s"
+                         % (row["calls"], row["seconds"] * 1000,
+                            row["p50"] * 1000, row["p90"] * 1000,
+                            row["p99"] * 1000, row["max"] * 1000,
+                            row["rows"], float(row["rows"]) / row["calls"],
+                            row["stmt"]))
+        return lines
+
+def _percentile(buckets, max_seconds, fraction):
+    """
+    Return the upper bound in seconds of the bucket holding the call
+    at fraction of all calls, or max_seconds if less.
+    """
+    want = fraction * sum(buckets)
+    seen = 0
+    for i in xrange(BUCKETS):
+        seen += buckets[i]
+        if seen >= want:
+            break
+    return min(max_seconds, (1 << i) / 1000000.0)
+
+def report_all(limit=None):
+    """Return the reports of every live collector as lines of text."""
+    lines = []
+    for i, ref in enumerate(_collectors):
+        stats = ref()
+        if stats is not None:
+            lines.append("SQL statistics of connection %d:" % (i + 1,))
+            lines += stats.report(limit)
+    return lines
@@ -3,10 +3,17 @@
 #
 
 import re
+import struct
 import base58
 import Crypto.Hash.SHA256 as SHA256
 from ybc_scrypt import getPoWHash
 
+try:
+    # Batch hashing without the GIL, in newer builds of ybc_scrypt.
+    from ybc_scrypt import getPoWHashes
+except ImportError:
+    getPoWHashes = None
+
 try:
     import Crypto.Hash.RIPEMD160 as RIPEMD160
 except:
@@ -38,16 +45,16 @@ def double_sha256(s):
     return SHA256.new(SHA256.new(s).digest()).digest()
 
 def scrypt(s):
-    import binascii
-    nTime = binascii.hexlify(s[68:72])
-    nTime = int(nTime, 16)
-    import struct
-    nTime = struct.pack('<I', nTime)
-    nTime = binascii.hexlify(nTime)
-    nTime = int(nTime, 16)
-    print nTime
+    # The N-factor depends on the header's nTime, at offset 68.
+    (nTime,) = struct.unpack_from('<I', s, 68)
     return getPoWHash(s, nTime)
 
+def scrypt_headers(headers):
+    """Return the proof-of-work hashes of a list of 80-byte headers."""
+    if getPoWHashes is None:
+        return map(scrypt, headers)
+    return getPoWHashes(''.join(headers))
+
 # Based on CBlock::BuildMerkleTree().
 def merkle(hashes):
     while True:
@@ -119,3 +126,17 @@ def decode_address(addr):
     if len(bytes) < 25:
         bytes = ('\0' * (25 - len(bytes))) + bytes
     return bytes[:-24], bytes[-24:-4]
+
+def process_is_alive(pid):
+    # XXX probably fails spectacularly on Windows.
+    import os
+    import errno
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError, e:
+        if e.errno == errno.EPERM:
+            return True  # process exists, but we can't send it signals.
+        if e.errno == errno.ESRCH:
+            return False # no such process.
+        raise
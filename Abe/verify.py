@@ -54,6 +54,41 @@ def verify_tx_merkle_hashes(store, logger, chain_id):
         logger.info("%d Merkle trees, %d bad", checked, bad)
     return checked, bad
 
+def verify_block_ss_destroyed(store, logger, chain_id):
+    """Recompute block_ss_destroyed one transaction at a time."""
+    checked, bad = 0, 0
+    for block_id, nTime, ss_destroyed in store.selectall("""
+        SELECT b.block_id, b.block_nTime, b.block_ss_destroyed
+          FROM block b
+          JOIN chain_candidate cc ON (b.block_id = cc.block_id)
+         WHERE cc.chain_id = ?
+           AND b.block_ss_destroyed IS NOT NULL""", (chain_id,)):
+        destroyed = 0
+        for (tx_id,) in store.selectall("""
+            SELECT tx_id
+              FROM block_tx
+             WHERE block_id = ?""", (block_id,)):
+            destroyed += int(store.selectrow("""
+                SELECT COALESCE(SUM(txout_approx.txout_approx_value *
+                                    (? - b.block_nTime)), 0)
+                  FROM block_txin bti
+                  JOIN txin ON (bti.txin_id = txin.txin_id)
+                  JOIN txout_approx ON (txin.txout_id = txout_approx.txout_id)
+                  JOIN block_tx obt ON (txout_approx.tx_id = obt.tx_id)
+                  JOIN block b ON (obt.block_id = b.block_id)
+                 WHERE bti.block_id = ? AND txin.tx_id = ?""",
+                                             (nTime, block_id, tx_id))[0])
+        if destroyed != int(ss_destroyed):
+            logger.error("block %d: block_ss_destroyed=%d but found %d",
+                         block_id, int(ss_destroyed), destroyed)
+            bad += 1
+        checked += 1
+        if checked % 1000 == 0:
+            logger.info("%d ss_destroyed, %d bad", checked, bad)
+    if checked % 1000 > 0:
+        logger.info("%d ss_destroyed, %d bad", checked, bad)
+    return checked, bad
+
 def main(argv):
     logging.basicConfig(level=logging.DEBUG)
     args, argv = readconf.parse_argv(argv, DataStore.CONFIG_DEFAULTS,
@@ -63,14 +98,18 @@ def main(argv):
         return 0
     store = DataStore.new(args)
     logger = logging.getLogger("verify")
-    checked, bad = 0, 0
+    checked, ss_checked, bad = 0, 0, 0
     for (chain_id,) in store.selectall("""
         SELECT chain_id FROM chain"""):
         logger.info("checking chain %d", chain_id)
         checked1, bad1 = verify_tx_merkle_hashes(store, logger, chain_id)
         checked += checked1
         bad += bad1
-    logger.info("All chains: %d Merkle trees, %d bad", checked, bad)
+        checked1, bad1 = verify_block_ss_destroyed(store, logger, chain_id)
+        ss_checked += checked1
+        bad += bad1
+    logger.info("All chains: %d Merkle trees, %d ss_destroyed, %d bad",
+                checked, ss_checked, bad)
     return bad and 1
 
 if __name__ == '__main__':
@@ -0,0 +1,77 @@
+# Copyright(C) 2012 by John Tobey <John.Tobey@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/agpl.html>.
+
+"""
+Load a synthetic chain into SQLite and check each block's
+block_ss_destroyed against the old per-transaction sum.
+
+Run from the top directory: python -m unittest test.test_ss_destroyed
+"""
+
+import os
+import shutil
+import tempfile
+import logging
+import unittest
+
+from Abe import DataStore, genchain, readconf, verify
+
+class SsDestroyedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="abe-test-")
+        datadir = os.path.join(self.dir, "data")
+        os.mkdir(datadir)
+
+        magic = None
+        for chain in DataStore.CHAIN_CONFIG:
+            if chain["chain"] == "Ybcoin":
+                magic = chain["magic"]
+        gen = genchain.ChainGenerator(magic, seed=1, txs_per_block=5,
+                                      inputs=2)
+        file = open(os.path.join(datadir, "blk-v1-0001.dat"), "wb")
+        for record in gen.generate(60, fork_every=20):
+            file.write(record)
+        file.close()
+
+        args, argv = readconf.parse_argv(
+            ["--dbtype", "sqlite3",
+             "--connect-args", os.path.join(self.dir, "abe.sqlite"),
+             "--datadir", datadir,
+             "--int-type", "str"],
+            dict(DataStore.CONFIG_DEFAULTS))
+        self.store = DataStore.new(args)
+        self.assertTrue(self.store.catch_up())
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def test_ss_destroyed(self):
+        store = self.store
+        logger = logging.getLogger(__name__)
+        (chain_id,) = store.selectrow("SELECT chain_id FROM chain")
+        (blocks,) = store.selectrow("""
+            SELECT COUNT(*)
+              FROM chain_candidate
+             WHERE chain_id = ?""", (chain_id,))
+        checked, bad = verify.verify_block_ss_destroyed(
+            store, logger, chain_id)
+        self.assertEqual(checked, int(blocks))
+        self.assertEqual(bad, 0)
+
+if __name__ == '__main__':
+    unittest.main()
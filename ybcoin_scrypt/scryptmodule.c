@@ -55,31 +55,110 @@ void scrypt_hash(const void* input, size_t inputlen, uint32_t *res, unsigned cha
 static PyObject *scrypt_getpowhash(PyObject *self, PyObject *args)
 {
     char *output;
+    char *header;
 	int timestamp;
     PyObject *value;
     PyStringObject *input;
     if (!PyArg_ParseTuple(args, "Si", &input, &timestamp))
         return NULL;
 
+    if (PyString_GET_SIZE(input) < 80) {
+        PyErr_SetString(PyExc_ValueError, "input must be at least 80 bytes");
+        return NULL;
+    }
+
     Py_INCREF(input);
+    // Read the buffer while holding the GIL.
+    header = PyString_AS_STRING(input);
 
     output = (char *)PyMem_Malloc(32);
+    if (output == NULL) {
+        Py_DECREF(input);
+        return PyErr_NoMemory();
+    }
 	memset(output, 0, 32);
 
-	scrypt_hash((char *)PyString_AsString((PyObject*) input), 80, (uint32_t *)output, GetNfactor(timestamp));
+	Py_BEGIN_ALLOW_THREADS
+	scrypt_hash(header, 80, (uint32_t *)output, GetNfactor(timestamp));
+	Py_END_ALLOW_THREADS
     Py_DECREF(input);
     value = Py_BuildValue("s#", output, 32);
     PyMem_Free(output);
     return value;
 }
 
+// Hash a buffer of consecutive 80-byte block headers.  Each header's
+// N-factor comes from its own nTime (little endian, offset 68).  The
+// GIL is released while hashing, so threads may hash in parallel.
+static PyObject *scrypt_getpowhashes(PyObject *self, PyObject *args)
+{
+    Py_buffer input;
+    Py_ssize_t count, i;
+    char *output;
+    PyObject *value, *hash;
 
+    if (!PyArg_ParseTuple(args, "s*", &input))
+        return NULL;
+
+    if (input.len % 80 != 0) {
+        PyBuffer_Release(&input);
+        PyErr_SetString(PyExc_ValueError,
+                        "input length must be a multiple of 80");
+        return NULL;
+    }
+
+    count = input.len / 80;
+    output = (char *)PyMem_Malloc(count * 32 + 1);
+    if (output == NULL) {
+        PyBuffer_Release(&input);
+        return PyErr_NoMemory();
+    }
+    memset(output, 0, count * 32);
+
+	Py_BEGIN_ALLOW_THREADS
+    for (i = 0; i < count; i++) {
+        const unsigned char *header = (const unsigned char *)input.buf + i * 80;
+        int timestamp = (int)(header[68] | (header[69] << 8) |
+                              (header[70] << 16) | ((uint32_t)header[71] << 24));
+        scrypt_hash(header, 80, (uint32_t *)(output + i * 32), GetNfactor(timestamp));
+    }
+	Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&input);
+
+    value = PyList_New(count);
+    if (value == NULL) {
+        PyMem_Free(output);
+        return NULL;
+    }
+    for (i = 0; i < count; i++) {
+        hash = PyString_FromStringAndSize(output + i * 32, 32);
+        if (hash == NULL) {
+            Py_DECREF(value);
+            PyMem_Free(output);
+            return NULL;
+        }
+        PyList_SET_ITEM(value, i, hash);
+    }
+    PyMem_Free(output);
+    return value;
+}
 
 static PyMethodDef ScryptMethods[] = {
     { "getPoWHash", scrypt_getpowhash, METH_VARARGS, "Returns the proof of work hash using scrypt" },
+    { "getPoWHashes", scrypt_getpowhashes, METH_VARARGS, "Returns a list of proof of work hashes of a buffer of 80-byte headers" },
     { NULL, NULL, 0, NULL }
 };
 
 PyMODINIT_FUNC initybc_scrypt(void) {
+    unsigned char header[80];
+    uint32_t hash[8];
+
     (void) Py_InitModule("ybc_scrypt", ScryptMethods);
+
+    // scrypt-jane runs its power-on self test on first use, guarded
+    // by an unlocked static flag.  Get it done before any thread can
+    // call scrypt without the GIL.
+    memset(header, 0, sizeof(header));
+    scrypt_hash(header, sizeof(header), hash, minNfactor);
 }